@@ -1,11 +1,36 @@
+import hmac
 import os
+from datetime import date, datetime, time, timedelta
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   jsonify, url_for, abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
-
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from current_user import (get_current_user, invalidate_current_user, CurrentUserGone,
+                          DEFAULT_TTL)
+from passwords import (configure_hashing, PasswordHashingBusy, DEFAULT_LOG_ROUNDS,
+                       DEFAULT_POOL_SIZE)
+from http_cache import (conditional_page, apply_cache_policy, release, static_url,
+                        STATIC_MAX_AGE)
+from fragments import configure_fragment_cache, DEFAULT_MAX_BYTES
+from metrics import configure_metrics, render as render_metrics, TimedQueuePool, CONTENT_TYPE
 from forms import UserAddForm, LoginForm, MessageForm, UpdateUserForm, OnlyCsrfForm
-from models import db, connect_db, User, Message, Like
+from models import db, connect_db, User, Message, Like, Follows, with_message_authors
+import likes
+from pagination import paginate_messages, paginate_users, Page
+from profiling import configure_profiling, DEFAULT_INTERVAL as DEFAULT_PROFILE_INTERVAL
+from ratelimit import TokenBucketLimiter
+import replicas
+from search import search_users, search_messages
+import slow_queries
+from sql_stats import configure_sql_stats, DEFAULT_REPEAT_WARNING
+import user_stats
+from timelines import (home_timeline, push_message, remove_message,
+                       backfill_follow, prune_follow, start_pulling, resume_pushing,
+                       rebuild_timelines, trim_timelines, DEFAULT_FANOUT_THRESHOLD,
+                       DEFAULT_PUSH_THRESHOLD)
 
 CURR_USER_KEY = "curr_user"
 
@@ -24,12 +49,140 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 #     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Send executemany() batches (such as buffered likes) to Postgres in pages
+# rather than one statement per round trip, and time pool checkouts for
+# /metrics.
+if database_url.startswith('postgresql'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'executemany_mode': 'values_plus_batch',
+        'poolclass': TimedQueuePool,
+    }
+
+# Read-only replicas of the database, comma-separated. GET and HEAD
+# requests read from them unless the client has just written, or they lag
+# more than REPLICA_MAX_LAG seconds (see replicas.py).
+replica_urls = [url.strip().replace('postgres://', 'postgresql://')
+                for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                if url.strip()]
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{number}': url for number, url in enumerate(replica_urls)}
+app.config['REPLICA_BINDS'] = list(app.config['SQLALCHEMY_BINDS'])
+app.config['REPLICA_MAX_LAG'] = float(
+    os.environ.get('REPLICA_MAX_LAG', replicas.DEFAULT_MAX_LAG))
+app.config['REPLICA_CHECK_INTERVAL'] = float(
+    os.environ.get('REPLICA_CHECK_INTERVAL', replicas.DEFAULT_CHECK_INTERVAL))
+app.config['REPLICA_PIN_SECONDS'] = float(
+    os.environ.get('REPLICA_PIN_SECONDS', replicas.DEFAULT_PIN_SECONDS))
+
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Authors with more followers than this are merged into timelines on read
+# instead of being pushed to every follower when they post, until they
+# drop to TIMELINE_PUSH_THRESHOLD and `flask resume-pushing` runs.
+app.config['TIMELINE_FANOUT_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_FANOUT_THRESHOLD', DEFAULT_FANOUT_THRESHOLD))
+app.config['TIMELINE_PUSH_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_PUSH_THRESHOLD', DEFAULT_PUSH_THRESHOLD))
+
+# Seconds a worker may reuse the logged-in user's id/username/images
+# without querying for them (0 disables the cache).
+app.config['CURRENT_USER_CACHE_TTL'] = float(
+    os.environ.get('CURRENT_USER_CACHE_TTL', DEFAULT_TTL))
+
+# bcrypt work factor, and the size of each worker's hashing process pool
+# (0 hashes on the request thread). See passwords.py for the other knobs.
+app.config['BCRYPT_LOG_ROUNDS'] = int(
+    os.environ.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS))
+app.config['BCRYPT_POOL_SIZE'] = int(
+    os.environ.get('BCRYPT_POOL_SIZE', DEFAULT_POOL_SIZE))
+
+# Login attempts allowed per username and per client address: a burst of
+# *_BURST, refilling at *_PER_MINUTE. Checked before any password hashing.
+app.config['LOGIN_USERNAME_BURST'] = int(
+    os.environ.get('LOGIN_USERNAME_BURST', 5))
+app.config['LOGIN_USERNAME_PER_MINUTE'] = float(
+    os.environ.get('LOGIN_USERNAME_PER_MINUTE', 5))
+app.config['LOGIN_ADDRESS_BURST'] = int(
+    os.environ.get('LOGIN_ADDRESS_BURST', 20))
+app.config['LOGIN_ADDRESS_PER_MINUTE'] = float(
+    os.environ.get('LOGIN_ADDRESS_PER_MINUTE', 20))
+
+# Number of reverse proxies in front of the app (1 on Heroku), so the
+# login limiter sees the client's address rather than the proxy's.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+# Memory each worker may use for cached message rows (see fragments.py).
+app.config['FRAGMENT_CACHE_BYTES'] = int(
+    os.environ.get('FRAGMENT_CACHE_BYTES', DEFAULT_MAX_BYTES))
+
+# Buffer like toggles in each worker and write them in batches (see
+# likes.py), instead of one transaction per toggle.
+app.config['LIKES_WRITE_BEHIND'] = os.environ.get('LIKES_WRITE_BEHIND') == '1'
+
+# Report each request's SQL statement count and database time in response
+# headers and/or a JSON log line (see sql_stats.py). Shapes run this many
+# times in one request are logged as possible N+1s either way.
+app.config['SQL_STATS_HEADER'] = os.environ.get('SQL_STATS_HEADER') == '1'
+app.config['SQL_STATS_LOG'] = os.environ.get('SQL_STATS_LOG') == '1'
+app.config['SQL_REPEAT_WARNING'] = int(
+    os.environ.get('SQL_REPEAT_WARNING', DEFAULT_REPEAT_WARNING))
+
+# Directory shared by every worker's metrics files, so /metrics reports
+# the whole server (see metrics.py). Unset, each worker reports itself.
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+# Bearer token a scraper sends for /metrics; admins can see it without.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Profile this fraction of requests, and any carrying an X-Profile-Token
+# signed with PROFILE_SECRET, writing flamegraph stacks to PROFILE_DIR
+# (see profiling.py). Off unless set.
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_SECRET'] = os.environ.get('PROFILE_SECRET')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+app.config['PROFILE_INTERVAL'] = float(
+    os.environ.get('PROFILE_INTERVAL', DEFAULT_PROFILE_INTERVAL))
+
+# Statements taking this long or longer are logged, explained and listed
+# at /admin/slow-queries (see slow_queries.py); 0 turns this off.
+app.config['SLOW_QUERY_SECONDS'] = float(
+    os.environ.get('SLOW_QUERY_SECONDS', slow_queries.DEFAULT_THRESHOLD))
+app.config['SLOW_QUERY_LOG_SIZE'] = int(
+    os.environ.get('SLOW_QUERY_LOG_SIZE', slow_queries.DEFAULT_LOG_SIZE))
+app.config['SLOW_QUERY_EXPLAIN'] = os.environ.get('SLOW_QUERY_EXPLAIN', '1') == '1'
+
+# Ids of the users who may see the /admin pages and /metrics,
+# comma-separated. Ids
+# rather than usernames, since users can rename themselves.
+app.config['ADMIN_USER_IDS'] = frozenset(
+    int(user_id) for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',')
+    if user_id.strip())
+
+# Seconds browsers may reuse static files requested without a version.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
+app.jinja_env.globals['static_url'] = static_url
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+configure_hashing(app)
+configure_fragment_cache(app)
+likes.configure_likes(app)
+configure_profiling(app)
+configure_metrics(app)
+configure_sql_stats(app)
+slow_queries.configure_slow_queries(app)
+replicas.configure_replicas(app)
+
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
+login_username_limiter = TokenBucketLimiter(
+    rate=app.config['LOGIN_USERNAME_PER_MINUTE'] / 60,
+    capacity=app.config['LOGIN_USERNAME_BURST'])
+login_address_limiter = TokenBucketLimiter(
+    rate=app.config['LOGIN_ADDRESS_PER_MINUTE'] / 60,
+    capacity=app.config['LOGIN_ADDRESS_BURST'])
 
 
 ##############################################################################
@@ -38,10 +191,18 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a CurrentUser: the full User row is only loaded if the
+    request uses more than its id, username, images and stats counts.
+    A user who has been deleted is logged out.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_current_user(session[CURR_USER_KEY],
+                                  ttl=app.config['CURRENT_USER_CACHE_TTL'])
+        if g.user is None:
+            do_logout()
 
     else:
         g.user = None
@@ -104,10 +265,19 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        # the address is checked first, so a flood from one client doesn't
+        # also lock its victims' usernames
+        if not (login_address_limiter.allow(request.remote_addr)
+                and login_username_limiter.allow(form.username.data.lower())):
+            flash("Too many login attempts. Please wait a minute and try again.",
+                  'danger')
+            return render_template('users/login.html', form=form), 429
+
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
         if user:
+            db.session.commit()  # saves a rehashed password, if any
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -130,6 +300,91 @@ def logout():
     return redirect('/login')
 
 
+##############################################################################
+# Paginated lists
+
+
+def wants_json():
+    """Did the client ask for a JSON page (used by app.js to load more)?"""
+
+    return (request.args.get('format') == 'json'
+            or request.accept_mimetypes.best == 'application/json')
+
+
+def liked_ids_for(messages):
+    """Ids of the `messages` the current user has liked, in one query."""
+
+    if not g.user or not messages:
+        return set()
+
+    # Only needs the user's id, so skip loading the full row for g.user.
+    ids = [message.id for message in messages]
+    liked = User.liked_message_ids(g.user, ids)
+
+    # toggles still waiting in the write-behind buffer
+    for message_id, is_liked in likes.pending_for(g.user.id).items():
+        if is_liked:
+            liked.add(message_id)
+        else:
+            liked.discard(message_id)
+    return liked & set(ids)
+
+
+def following_ids_for(users):
+    """Ids of the `users` the current user follows, in one query."""
+
+    if not g.user or not users:
+        return set()
+
+    # Only needs the user's id, so skip loading the full row for g.user.
+    return User.following_ids_among(g.user, [user.id for user in users])
+
+
+def page_versions(user_id):
+    """Validators for a page about `user_id`, as seen by g.user.
+
+    The owner's and viewer's `User.version`s, fetched in one indexed
+    lookup, plus the viewer's likes still in the write-behind buffer.
+    404s if there's no such user.
+    """
+
+    ids = {user_id, g.user.id} if g.user else {user_id}
+    versions = dict(db.session.query(User.id, User.version)
+                    .filter(User.id.in_(ids)))
+
+    if user_id not in versions:
+        abort(404)
+
+    viewer = None
+    if g.user:
+        pending = sorted(likes.pending_for(g.user.id).items())
+        viewer = (g.user.id, versions.get(g.user.id), pending)
+    return versions[user_id], viewer
+
+
+def render_page(template, items_template, page, **context):
+    """Render one page of a paginated list.
+
+    Full requests get `template`; JSON requests get just the rendered
+    `items_template` rows and the URL of the next page.
+    """
+
+    next_url = None
+    if page.next_cursor:
+        args = request.args.to_dict()
+        args.pop('format', None)
+        args['cursor'] = page.next_cursor
+        next_url = url_for(request.endpoint, **request.view_args, **args)
+
+    if wants_json():
+        return jsonify(
+            html=render_template(items_template, **context),
+            next=next_url,
+        )
+
+    return render_template(template, next_url=next_url, **context)
+
+
 ##############################################################################
 # General user routes:
 
@@ -137,30 +392,44 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames, locations and
+    bios (best matches first), and a 'cursor' param for the next page of
+    results.
     """
 
     message_form = MessageForm()
 
-    search = request.args.get('q')
+    search = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor')
 
     if not search:
-        users = User.query.all()
+        page = paginate_users(User.query, cursor)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = search_users(search, cursor)
 
-    return render_template('users/index.html', users=users, message_form=message_form)
+    return render_page('users/index.html', 'users/cards.html', page,
+                       users=page.items,
+                       following_ids=following_ids_for(page.items),
+                       message_form=message_form)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    message_form = MessageForm()
+    def render():
+        user = User.query.get_or_404(user_id)
+        messages = (Message.query
+                    .options(with_message_authors)
+                    .filter_by(user_id=user.id))
+        page = paginate_messages(messages, request.args.get('cursor'))
 
-    user = User.query.get_or_404(user_id)
+        return render_page('users/show.html', 'messages/items.html', page,
+                           user=user, messages=page.items,
+                           liked_ids=liked_ids_for(page.items),
+                           message_form=MessageForm())
 
-    return render_template('users/show.html', user=user, message_form=message_form)
+    return conditional_page(page_versions(user_id), render, per_viewer=True)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -171,10 +440,19 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message_form = MessageForm()
+    def render():
+        user = User.query.get_or_404(user_id)
+        following = (User.query
+                     .join(Follows, Follows.user_being_followed_id == User.id)
+                     .filter(Follows.user_following_id == user.id))
+        page = paginate_users(following, request.args.get('cursor'))
+
+        return render_page('users/following.html', 'users/cards.html', page,
+                           user=user, users=page.items,
+                           following_ids=following_ids_for(page.items),
+                           message_form=MessageForm())
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user, message_form=message_form)
+    return conditional_page(page_versions(user_id), render, per_viewer=True)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -185,10 +463,19 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message_form = MessageForm()
+    def render():
+        user = User.query.get_or_404(user_id)
+        followers = (User.query
+                     .join(Follows, Follows.user_following_id == User.id)
+                     .filter(Follows.user_being_followed_id == user.id))
+        page = paginate_users(followers, request.args.get('cursor'))
+
+        return render_page('users/followers.html', 'users/cards.html', page,
+                           user=user, users=page.items,
+                           following_ids=following_ids_for(page.items),
+                           message_form=MessageForm())
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user, message_form=message_form)
+    return conditional_page(page_versions(user_id), render, per_viewer=True)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -201,6 +488,10 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    db.session.flush()
+    backfill_follow(g.user.id, followed_user.id)
+    user_stats.follow_added(g.user.id, followed_user.id)
+    start_pulling(followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -216,6 +507,8 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    prune_follow(g.user.id, followed_user.id)
+    user_stats.follow_removed(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -230,17 +523,21 @@ def profile():
         return redirect("/")
 
     message_form = MessageForm()
+
+    # Edit the stored row, not the possibly-stale cached record
+    current = g.user.load()
+
     form = UpdateUserForm(
-        username=g.user.username,
-        email=g.user.email,
-        image_url=g.user.image_url,
-        header_image_url=g.user.header_image_url,
-        location=g.user.location,
-        bio=g.user.bio
+        username=current.username,
+        email=current.email,
+        image_url=current.image_url,
+        header_image_url=current.header_image_url,
+        location=current.location,
+        bio=current.bio
     )
 
     if form.validate_on_submit():
-        user = User.authenticate(g.user.username, form.password.data)
+        user = User.authenticate(current.username, form.password.data)
         
         if user:
             user.username = form.username.data
@@ -250,7 +547,9 @@ def profile():
             user.location = form.location.data
             user.bio = form.bio.data
 
+            user_stats.profile_changed(user.id)
             db.session.commit()
+            invalidate_current_user(user.id)
 
             return redirect(f'/users/{user.id}')
 
@@ -259,7 +558,7 @@ def profile():
             return redirect('/')
 
     else:
-        return render_template("/users/edit.html", form=form, user=g.user, message_form=message_form)
+        return render_template("/users/edit.html", form=form, user=current, message_form=message_form)
 
 
 @app.route('/users/delete', methods=["POST"])
@@ -272,8 +571,10 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_stats.user_deleted(g.user.id)
+    db.session.delete(g.user.load())
     db.session.commit()
+    invalidate_current_user(g.user.id)
 
     return redirect("/signup")
 
@@ -297,6 +598,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        push_message(msg)
+        user_stats.message_added(g.user.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -308,10 +612,13 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    message_form = MessageForm()    
-    
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg, message_form=message_form)
+    msg = Message.query.get_or_404(message_id)
+    validators = (msg.id, msg.text, msg.timestamp, msg.user.version)
+
+    return conditional_page(validators, lambda: render_template(
+        'messages/show.html', message=msg,
+        liked_ids=liked_ids_for([msg]),
+        message_form=MessageForm()))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -323,43 +630,140 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    remove_message(msg.id)
+    user_stats.message_deleted(msg)
     db.session.delete(msg)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
+
+def message_search_page():
+    """Run the message search described by the querystring.
+
+    Takes 'q' (search terms), optional 'author' (username), 'since' and
+    'until' (inclusive YYYY-MM-DD dates) and 'cursor'.
+    """
+
+    terms = request.args.get('q', '').strip()
+    if not terms:
+        return Page([], None)
+
+    try:
+        since = request.args.get('since')
+        since = since and datetime.combine(date.fromisoformat(since), time())
+        until = request.args.get('until')
+        until = until and datetime.combine(date.fromisoformat(until) + timedelta(days=1), time())
+    except ValueError:
+        abort(400)
+
+    return search_messages(terms,
+                           author=request.args.get('author') or None,
+                           since=since,
+                           until=until,
+                           cursor=request.args.get('cursor'))
+
+
+@app.route('/messages/search')
+def messages_search():
+    """Search messages, most relevant first."""
+
+    message_form = MessageForm()
+
+    page = message_search_page()
+    messages = [message for message, rank in page.items]
+
+    return render_page('messages/search.html', 'messages/items.html', page,
+                       messages=messages,
+                       liked_ids=liked_ids_for(messages),
+                       message_form=message_form)
+
+
+@app.route('/api/messages/search')
+def messages_search_json():
+    """Search messages; return the results and next page URL as JSON."""
+
+    page = message_search_page()
+
+    next_url = None
+    if page.next_cursor:
+        next_url = url_for('messages_search_json',
+                           **dict(request.args.to_dict(), cursor=page.next_cursor))
+
+    return jsonify(
+        messages=[{
+            'id': message.id,
+            'text': message.text,
+            'timestamp': message.timestamp.isoformat(),
+            'rank': rank,
+            'user': {
+                'id': message.user.id,
+                'username': message.user.username,
+                'image_url': message.user.image_url,
+            },
+        } for message, rank in page.items],
+        next=next_url,
+    )
+
 ##############################################################################
 # Likes routes:
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 def like_message(message_id):
-    """Like a message."""
+    """Like or unlike a message, then show the user's likes."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-
-    if msg.is_liked_by(g.user):
-        like = Like.query.get((g.user.id, message_id))
-        db.session.delete(like)
-        db.session.commit()
-    else:
-        like = Like(user_id=g.user.id, message_id=message_id)
-        db.session.add(like)
-        db.session.commit()
+    if likes.toggle(g.user.id, message_id) is None:
+        abort(404)
+    db.session.commit()
 
     return redirect(f"/users/{g.user.id}/likes")
 
+
+@app.route('/api/messages/<int:message_id>/like', methods=["POST"])
+def api_toggle_like(message_id):
+    """Like or unlike a message; return its new state as JSON.
+
+    Returns {liked, likes}: whether the current user now likes the
+    message, and how many users do.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    toggled = likes.toggle(g.user.id, message_id)
+    if toggled is None:
+        return jsonify(error="No such message."), 404
+    db.session.commit()
+
+    liked, like_count = toggled
+    return jsonify(liked=liked, likes=like_count)
+
 @app.route('/users/<int:user_id>/likes')
 def liked_messages_show(user_id):
     """Show user's likes"""
 
-    message_form = MessageForm()
+    # users see their own buffered likes here straight away
+    if g.user and g.user.id == user_id and likes.pending_for(user_id):
+        likes.buffer.flush()
+        replicas.pin_to_primary()
 
-    user = User.query.get_or_404(user_id)
+    def render():
+        user = User.query.get_or_404(user_id)
+        liked_messages = (Message.query
+                          .options(with_message_authors)
+                          .join(Like, Like.message_id == Message.id)
+                          .filter(Like.user_id == user.id))
+        page = paginate_messages(liked_messages, request.args.get('cursor'))
 
-    return render_template('messages/liked.html', user=user, message_form=message_form)
+        return render_page('messages/liked.html', 'messages/items.html', page,
+                           user=user, messages=page.items,
+                           liked_ids=liked_ids_for(page.items),
+                           message_form=MessageForm())
+
+    return conditional_page(page_versions(user_id), render, per_viewer=True)
 
 ##############################################################################
 # Homepage and error pages
@@ -370,44 +774,113 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, read from
+      the user's materialized timeline
     """
  
     if g.user:
 
         message_form = MessageForm()
 
-        followed_user_ids = {followed_user.id for followed_user in g.user.following}
-        followed_user_ids.add(g.user.id) # also display logged in user's messages
-
-        messages = (Message.query
-                    .filter(Message.user_id.in_(followed_user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages = home_timeline(g.user.id)
 
-        return render_template('home.html', messages=messages, message_form=message_form)
+        return render_template('home.html', messages=messages,
+                               liked_ids=liked_ids_for(messages),
+                               message_form=message_form)
 
     else:
-        return render_template('home-anon.html')
+        # only changes when the app is redeployed
+        return conditional_page(None, lambda: render_template('home-anon.html'),
+                                last_modified=release()[1])
+
+
+@app.route('/metrics')
+def metrics_page():
+    """Prometheus metrics, for every worker if METRICS_DIR is set.
+
+    Only for requests with `Authorization: Bearer <METRICS_TOKEN>`, and
+    the ADMIN_USER_IDS.
+    """
+
+    token = app.config['METRICS_TOKEN']
+    scraper = token and hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+    if not (scraper or (g.user and g.user.id in app.config['ADMIN_USER_IDS'])):
+        abort(404)
+
+    return app.response_class(render_metrics(), content_type=CONTENT_TYPE)
+
+
+@app.route('/admin/slow-queries')
+def slow_queries_page():
+    """This worker's recent slow queries, for the ADMIN_USER_IDS."""
+
+    if not (g.user and g.user.id in app.config['ADMIN_USER_IDS']):
+        abort(404)
+
+    return render_template('admin/slow_queries.html',
+                           queries=slow_queries.records(),
+                           threshold=app.config['SLOW_QUERY_SECONDS'],
+                           message_form=MessageForm())
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild every user's home timeline from messages and follows."""
+
+    rebuild_timelines()
+    db.session.commit()
+
+
+@app.cli.command('trim-timelines')
+def trim_timelines_command():
+    """Cut every home timeline back to its newest entries."""
+
+    trim_timelines()
+    db.session.commit()
+
+
+@app.cli.command('resume-pushing')
+def resume_pushing_command():
+    """Push again to the followers of pulled authors who've lost followers; run this periodically."""
+
+    resume_pushing()
+
+
+@app.cli.command('repair-user-stats')
+def repair_user_stats_command():
+    """Recompute every user's stats counts from the base tables."""
+
+    user_stats.repair_user_stats()
+    db.session.commit()
+
+
+@app.errorhandler(PasswordHashingBusy)
+def password_hashing_busy(e):
+    '''Too many logins/signups are hashing passwords right now.'''
+    return "Too many sign-ins in progress, please try again shortly.", 503, {'Retry-After': '5'}
+
+
+@app.errorhandler(CurrentUserGone)
+def current_user_gone(e):
+    '''The logged-in user was deleted after their record was cached: log them out.'''
+    do_logout()
+    g.user = None
+    return redirect("/")
+
 
 @app.errorhandler(404)
 def page_not_found(e):
     '''Error page.'''
-    return render_template('404.html'), 404
+    return render_template('404.html', message_form=MessageForm()), 404
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# HTTP caching: long-lived versioned static files, conditional pages, and
+# `private, no-cache` for everything else (see http_cache.py).
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Set the cache policy for responses that didn't choose their own."""
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+    return apply_cache_policy(response)
@@ -0,0 +1,9 @@
+"""Performance benchmarks for Warbler.
+
+Each benchmark is a script run from the project root against a scratch
+database, e.g.:
+
+    DATABASE_URL=postgresql:///warbler_bench python -m benchmarks.timeline_latency
+
+Benchmarks drop and recreate every table in that database.
+"""
@@ -0,0 +1,125 @@
+"""Homepage latency while /login is flooded with bad passwords.
+
+Builds a small timeline dataset, then measures a reader's homepage
+p50/p95/p99 in three scenarios:
+
+- quiet: no login traffic
+- unlimited: flood threads post wrong passwords for real usernames from a
+  handful of client addresses, with the login limiter switched off
+- limited: the same flood with the configured LOGIN_* limits
+
+The flood's attempts, 429s and bcrypt checks are reported with each run.
+
+    DATABASE_URL=postgresql:///warbler_bench \
+        python -m benchmarks.login_flood --flood-threads 8 --reads 200
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler_bench')
+
+from app import app, login_username_limiter, login_address_limiter
+from models import db
+from passwords import hashing_stats
+from timelines import rebuild_timelines
+from user_stats import repair_user_stats
+from benchmarks.stats import summarize
+from benchmarks.timeline_latency import build_dataset, time_requests, NUM_AUTHORS
+
+NUM_FOLLOWERS = 100
+
+ATTACKER_ADDRESSES = [f'203.0.113.{n}' for n in range(1, 5)]
+
+UNLIMITED = 10 ** 9
+
+
+def flood(stop, num_users, rng, counts, lock):
+    """Post wrong passwords for random users until `stop` is set."""
+
+    client = app.test_client()
+    while not stop.is_set():
+        resp = client.post('/login',
+                           environ_base={'REMOTE_ADDR': rng.choice(ATTACKER_ADDRESSES)},
+                           data={'username': f'user{rng.randint(1, num_users)}',
+                                 'password': 'not-the-password'})
+        with lock:
+            counts['attempts'] += 1
+            counts['rejected'] += resp.status_code == 429
+
+
+def measure(scenario, reader_id, num_users, flood_threads, reads):
+    """Homepage latency for `scenario`, with its flood running if any."""
+
+    login_username_limiter.clear()
+    login_address_limiter.clear()
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    counts = {'attempts': 0, 'rejected': 0}
+    threads = [threading.Thread(target=flood,
+                                args=(stop, num_users, random.Random(n), counts, lock))
+               for n in range(flood_threads if scenario != 'quiet' else 0)]
+
+    checks = hashing_stats()['checks']
+    for thread in threads:
+        thread.start()
+    try:
+        durations = time_requests(app.test_client(), reader_id, 'GET', '/', reads)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    return {
+        'scenario': scenario,
+        'homepage': summarize(durations),
+        'login_attempts': counts['attempts'],
+        'login_rejected': counts['rejected'],
+        'bcrypt_checks': hashing_stats()['checks'] - checks,
+    }
+
+
+def run(flood_threads, reads):
+    """Run every scenario, printing JSON lines."""
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        reader_id, _ = build_dataset(NUM_FOLLOWERS, random.Random(0))
+        repair_user_stats()
+        rebuild_timelines()
+        db.session.commit()
+
+    num_users = 2 + NUM_AUTHORS + NUM_FOLLOWERS
+    limits = {limiter: limiter.capacity
+              for limiter in (login_username_limiter, login_address_limiter)}
+    results = []
+
+    for scenario in ('quiet', 'unlimited', 'limited'):
+        for limiter, capacity in limits.items():
+            limiter.capacity = UNLIMITED if scenario == 'unlimited' else capacity
+
+        results.append(measure(scenario, reader_id, num_users, flood_threads, reads))
+        print(json.dumps(results[-1]), flush=True)
+
+    for limiter, capacity in limits.items():
+        limiter.capacity = capacity
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--flood-threads', type=int, default=8)
+    parser.add_argument('--reads', type=int, default=200)
+    args = parser.parse_args()
+
+    run(args.flood_threads, args.reads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Password check throughput through the hashing pool.
+
+Drives `passwords.check_password` from several request threads at once
+and reports logins per second, overall and per core used, along with
+the pool's queue-time stats. No database is needed.
+
+    python -m benchmarks.password_hashing --rounds 12 --pool-size 2 --threads 8
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+import passwords
+from benchmarks.stats import summarize
+
+
+def run(rounds, pool_size, threads, logins):
+    """Check `logins` passwords from `threads` threads; return a summary."""
+
+    app = Flask(__name__)
+    app.config.update(BCRYPT_LOG_ROUNDS=rounds,
+                      BCRYPT_POOL_SIZE=pool_size,
+                      BCRYPT_MAX_CONCURRENT=max(threads, 1),
+                      BCRYPT_QUEUE_TIMEOUT=3600)
+    passwords.configure_hashing(app)
+
+    hashed = passwords.hash_password('benchmark-password')
+
+    def login(_):
+        start = time.perf_counter()
+        assert passwords.check_password(hashed, 'benchmark-password')
+        return time.perf_counter() - start
+
+    # warm up the pool so process start-up isn't measured
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(login, range(max(pool_size, 1))))
+
+    before = passwords.hashing_stats()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        durations = list(executor.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    after = passwords.hashing_stats()
+
+    cores = min(max(pool_size, 1), os.cpu_count() or 1)
+    checks = after['checks'] - before['checks']
+
+    return {
+        'rounds': rounds,
+        'pool_size': pool_size,
+        'threads': threads,
+        'logins_per_second': round(logins / elapsed, 2),
+        'logins_per_second_per_core': round(logins / elapsed / cores, 2),
+        'login_latency': summarize(durations),
+        'mean_queue_ms': round((after['queue_seconds_total']
+                                - before['queue_seconds_total']) / checks * 1000, 3),
+        'max_queue_ms': round(after['queue_seconds_max'] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=passwords.DEFAULT_LOG_ROUNDS)
+    parser.add_argument('--pool-size', type=int, default=passwords.DEFAULT_POOL_SIZE)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=100)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rounds, args.pool_size, args.threads, args.logins)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""Throughput and latency of the core routes under a weighted request mix.
+
+Seeds a dataset with generator/create_csvs.py and seed.py, logs in a set
+of its users through /login, then has each of them replay a weighted mix
+of homepage, users_show, list_users, like_message, messages_add and
+add_follow requests from its own thread. Reports, as one JSON document:
+
+- overall and per-route throughput (requests per second of wall time)
+- per-route p50/p95/p99 latency
+- per-route SQL statements and database time per request
+- the commit benchmarked, so runs can be compared across commits
+
+    DATABASE_URL=postgresql:///warbler_bench \
+        python -m benchmarks.route_mix --tier 1k --clients 8 --requests 2000 \
+        --output route_mix.json
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler_bench')
+
+from sqlalchemy import func
+
+from app import app
+from models import db, User, Message, Follows
+from seed import seed
+from sql_stats import record_queries
+from benchmarks.stats import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The generator's users all have this password.
+PASSWORD = 'password'
+
+DEFAULT_MIX = 'homepage=40,users_show=25,list_users=10,like_message=15,messages_add=5,add_follow=5'
+
+
+def parse_mix(mix):
+    """{route: weight} from 'route=weight,...'."""
+
+    weights = {}
+    for part in mix.split(','):
+        route, weight = part.split('=')
+        if route not in ROUTES:
+            raise ValueError(f"unknown route {route!r}; choose from {', '.join(ROUTES)}")
+        weights[route] = float(weight)
+    return weights
+
+
+def load_dataset(tier, data_dir, seed_value):
+    """Generate (unless `data_dir` is given) and seed the dataset."""
+
+    if data_dir:
+        with app.app_context():
+            seed(data_dir)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                        '--tier', tier, '--seed', seed_value, '--out', tmp], check=True)
+        with app.app_context():
+            seed(tmp)
+
+
+class Client:
+    """One logged-in synthetic user and the state its requests need."""
+
+    def __init__(self, user, address, num_users, num_messages, following, rng):
+        self.user_id = user.id
+        self.client = app.test_client()
+        self.num_users = num_users
+        self.num_messages = num_messages
+        self.following = following
+        self.rng = rng
+
+        resp = self.client.post('/login', data={'username': user.username, 'password': PASSWORD},
+                                environ_base={'REMOTE_ADDR': address})
+        assert resp.status_code == 302, f"login as {user.username} failed: {resp.status_code}"
+        self.environ = {'REMOTE_ADDR': address}
+
+    def request(self, route):
+        method, url, kwargs = ROUTES[route](self)
+        return self.client.open(url, method=method, environ_base=self.environ, **kwargs)
+
+
+def _homepage(client):
+    return 'GET', '/', {}
+
+
+def _users_show(client):
+    return 'GET', f'/users/{client.rng.randint(1, client.num_users)}', {}
+
+
+def _list_users(client):
+    return 'GET', '/users', {}
+
+
+def _like_message(client):
+    return 'POST', f'/messages/{client.rng.randint(1, client.num_messages)}/like', {}
+
+
+def _messages_add(client):
+    return 'POST', '/messages/new', {'data': {'text': f'benchmark post {client.rng.random()}'}}
+
+
+def _add_follow(client):
+    # following someone twice is an error, so pick someone new
+    while True:
+        followed = client.rng.randint(1, client.num_users)
+        if followed != client.user_id and followed not in client.following:
+            client.following.add(followed)
+            return 'POST', f'/users/follow/{followed}', {}
+
+
+ROUTES = {
+    'homepage': _homepage,
+    'users_show': _users_show,
+    'list_users': _list_users,
+    'like_message': _like_message,
+    'messages_add': _messages_add,
+    'add_follow': _add_follow,
+}
+
+
+def replay(client, weights, count, warmup, results):
+    """Issue `count` requests drawn from `weights`, recording the last count - warmup."""
+
+    routes, route_weights = zip(*weights.items())
+    for i in range(count):
+        route = client.rng.choices(routes, route_weights)[0]
+
+        with record_queries() as stats:
+            start = time.perf_counter()
+            resp = client.request(route)
+            duration = time.perf_counter() - start
+
+        if i < warmup:
+            continue
+        result = results[route]
+        result['durations'].append(duration)
+        result['statements'] += stats.statements
+        result['db_seconds'] += stats.db_seconds
+        result['errors'] += resp.status_code >= 400
+
+
+def run(tier, data_dir, seed_value, num_clients, num_requests, warmup, weights):
+    """Seed, log in, replay the mix; return the report."""
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    load_dataset(tier, data_dir, seed_value)
+
+    rng = random.Random(seed_value)
+    with app.app_context():
+        num_users = db.session.query(func.max(User.id)).scalar()
+        num_messages = db.session.query(func.max(Message.id)).scalar()
+        users = User.query.filter(User.id.in_(rng.sample(range(1, num_users + 1),
+                                                         num_clients))).all()
+        follows = defaultdict(set)
+        for followed, follower in (db.session.query(Follows.user_being_followed_id,
+                                                    Follows.user_following_id)
+                                   .filter(Follows.user_following_id.in_([u.id for u in users]))):
+            follows[follower].add(followed)
+
+        clients = [Client(user, f'198.51.100.{n % 250 + 1}', num_users, num_messages,
+                          follows[user.id], random.Random(f'{seed_value}:{n}'))
+                   for n, user in enumerate(users)]
+
+    per_client = num_requests // num_clients
+    results = [defaultdict(lambda: {'durations': [], 'statements': 0, 'db_seconds': 0.0,
+                                           'errors': 0})
+               for _ in clients]
+    threads = [threading.Thread(target=replay,
+                                args=(client, weights, per_client + warmup, warmup,
+                                      client_results))
+               for client, client_results in zip(clients, results)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    routes = {}
+    for route in weights:
+        durations = [d for r in results for d in r[route]['durations']]
+        if not durations:
+            continue
+        statements = sum(r[route]['statements'] for r in results)
+        db_seconds = sum(r[route]['db_seconds'] for r in results)
+        routes[route] = {
+            **summarize(durations),
+            'throughput_rps': round(len(durations) / elapsed, 1),
+            'statements_per_request': round(statements / len(durations), 2),
+            'db_ms_per_request': round(db_seconds * 1000 / len(durations), 3),
+            'errors': sum(r[route]['errors'] for r in results),
+        }
+
+    total = sum(route['count'] for route in routes.values())
+    return {
+        'commit': _commit(),
+        'tier': None if data_dir else tier,
+        'data_dir': data_dir,
+        'seed': seed_value,
+        'clients': num_clients,
+        'mix': weights,
+        'elapsed_s': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 1),
+        'routes': routes,
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tier', default='1k', help='generator tier to seed')
+    parser.add_argument('--data-dir', help='seed these CSVs instead of generating a tier')
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='recorded requests, split between the clients')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unrecorded requests per client before recording')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='route=weight,...')
+    parser.add_argument('--output', help='write the JSON report here as well')
+    args = parser.parse_args()
+
+    report = run(args.tier, args.data_dir, args.seed, args.clients, args.requests,
+                 args.warmup, parse_mix(args.mix))
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
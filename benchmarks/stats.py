@@ -0,0 +1,23 @@
+"""Summary statistics shared by the benchmarks."""
+
+import math
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of `samples` (pct in 0-100)."""
+
+    ordered = sorted(samples)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+def summarize(samples):
+    """Latency summary, in milliseconds, of a list of durations in seconds."""
+
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
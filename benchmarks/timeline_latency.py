@@ -0,0 +1,147 @@
+"""Homepage latency for push-only versus hybrid timelines.
+
+For each follower count, builds a reader who follows one high-follower
+author plus a set of ordinary authors, then measures:
+
+- homepage p50/p95/p99 for the reader
+- posting latency for the high-follower author (the fan-out cost)
+
+under push-only timelines and under the hybrid threshold.
+
+    DATABASE_URL=postgresql:///warbler_bench \
+        python -m benchmarks.timeline_latency --followers 100,1000,10000,50000
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler_bench')
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+from timelines import rebuild_timelines
+from user_stats import repair_user_stats
+from benchmarks.stats import summarize
+
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+NUM_AUTHORS = 100
+MESSAGES_PER_AUTHOR = 20
+BIG_AUTHOR_MESSAGES = 200
+
+PUSH_ONLY_THRESHOLD = 2 ** 62
+
+
+def build_dataset(num_followers, rng):
+    """Create the reader, authors and follows; return (reader_id, big_author_id).
+
+    Tables are recreated, so users get ids 1..n in insertion order.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    num_users = 2 + NUM_AUTHORS + num_followers
+    db.session.execute(User.__table__.insert(), [
+        dict(username=f'user{i}', email=f'user{i}@bench.test',
+             password=PASSWORD_HASH)
+        for i in range(1, num_users + 1)
+    ])
+
+    reader_id, big_author_id = 1, 2
+    author_ids = range(3, 3 + NUM_AUTHORS)
+
+    follows = [dict(user_following_id=reader_id, user_being_followed_id=followed)
+               for followed in [big_author_id, *author_ids]]
+    follows += [dict(user_following_id=follower, user_being_followed_id=big_author_id)
+                for follower in range(3 + NUM_AUTHORS, num_users + 1)]
+    db.session.execute(Follows.__table__.insert(), follows)
+
+    now = datetime.utcnow()
+
+    def message(user_id):
+        return dict(user_id=user_id, text=f'bench message by {user_id}',
+                    timestamp=now - timedelta(seconds=rng.randint(0, 86400 * 30)))
+
+    messages = [message(big_author_id) for _ in range(BIG_AUTHOR_MESSAGES)]
+    messages += [message(author_id)
+                 for author_id in author_ids
+                 for _ in range(MESSAGES_PER_AUTHOR)]
+    db.session.execute(Message.__table__.insert(), messages)
+    db.session.commit()
+
+    return reader_id, big_author_id
+
+
+def time_requests(client, user_id, method, url, count, **kwargs):
+    """Issue `count` requests as `user_id`; return their durations."""
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    durations = []
+    for _ in range(count):
+        start = time.perf_counter()
+        resp = client.open(url, method=method, **kwargs)
+        durations.append(time.perf_counter() - start)
+        assert resp.status_code in (200, 302), resp.status_code
+
+    return durations
+
+
+def run(follower_counts, threshold, reads, writes):
+    """Benchmark both modes at each follower count, printing JSON lines."""
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    rng = random.Random(0)
+    results = []
+
+    for num_followers in follower_counts:
+        for mode, mode_threshold in [('push', PUSH_ONLY_THRESHOLD),
+                                     ('hybrid', threshold)]:
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = mode_threshold
+
+            with app.app_context():
+                reader_id, big_author_id = build_dataset(num_followers, rng)
+                repair_user_stats()
+                rebuild_timelines()
+                db.session.commit()
+
+            client = app.test_client()
+            post_durations = time_requests(client, big_author_id, 'POST',
+                                           '/messages/new', writes,
+                                           data={'text': 'benchmark post'})
+            read_durations = time_requests(client, reader_id, 'GET', '/', reads)
+
+            results.append({
+                'followers': num_followers,
+                'mode': mode,
+                'threshold': mode_threshold if mode == 'hybrid' else None,
+                'homepage': summarize(read_durations),
+                'post': summarize(post_durations),
+            })
+            print(json.dumps(results[-1]), flush=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--followers', default='100,1000,10000,50000',
+                        help='comma-separated follower counts for the big author')
+    parser.add_argument('--threshold', type=int, default=1000,
+                        help='TIMELINE_FANOUT_THRESHOLD for the hybrid runs')
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--writes', type=int, default=20)
+    args = parser.parse_args()
+
+    run([int(n) for n in args.followers.split(',')],
+        args.threshold, args.reads, args.writes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Cheap loading of the logged-in user for every request.
+
+Most requests only need the current user's id, username and images (for
+the nav bar and ownership checks) and their stats counts (for the home
+page). Those fields are kept in a short-lived, worker-local cache, so an
+authenticated request normally runs no query to find out who is logged
+in. The full `User` row is loaded from the database only when a handler
+or template touches anything else.
+
+Writes that change a user's cached fields forget their record when they
+commit (see `invalidate_after_commit`); other workers may show the old
+values for up to the cache's TTL.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, User
+
+DEFAULT_TTL = 30
+
+MAX_ENTRIES = 10000
+
+UserRecord = namedtuple('UserRecord', [
+    'id', 'username', 'image_url', 'header_image_url',
+    'messages_count', 'following_count', 'followers_count', 'likes_count',
+])
+
+# Session.info key for the users to forget once the transaction commits.
+PENDING_KEY = 'invalidate_current_users'
+
+_records = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+class CurrentUserGone(Exception):
+    """The logged-in user's row has been deleted since their record was cached."""
+
+
+class CurrentUser:
+    """The logged-in user, as seen by one request.
+
+    Cached fields are served from the `UserRecord`. Any other attribute
+    (relationships, counts, methods) loads the full `User` on first use
+    and is read from it, so handlers can treat this like a `User`. Pass
+    `load()` to session methods such as `db.session.delete`.
+    """
+
+    __slots__ = UserRecord._fields + ('_user',)
+
+    def __init__(self, record):
+        for name, value in zip(UserRecord._fields, record):
+            setattr(self, name, value)
+        self._user = None
+
+    def load(self):
+        """The full `User` row, fetched once per request.
+
+        Raises `CurrentUserGone` if the user has been deleted, perhaps
+        by another worker whose invalidation this one never saw.
+        """
+
+        if self._user is None:
+            self._user = User.query.get(self.id)
+            if self._user is None:
+                invalidate_current_user(self.id)
+                raise CurrentUserGone(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def get_current_user(user_id, ttl=DEFAULT_TTL):
+    """The `CurrentUser` for `user_id`, or None if there's no such user."""
+
+    now = time.monotonic()
+
+    with _lock:
+        cached = _records.get(user_id)
+        if cached and cached[0] > now:
+            _stats['hits'] += 1
+            _records.move_to_end(user_id)
+            return CurrentUser(cached[1])
+        _stats['misses'] += 1
+
+    row = (db.session.query(*(getattr(User, name) for name in UserRecord._fields))
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        invalidate_current_user(user_id)
+        return None
+
+    record = UserRecord(*row)
+    if ttl > 0:
+        with _lock:
+            _records[user_id] = (now + ttl, record)
+            _records.move_to_end(user_id)
+            while len(_records) > MAX_ENTRIES:
+                _records.popitem(last=False)
+
+    return CurrentUser(record)
+
+
+def cache_stats():
+    """Hits and misses of this worker's current-user cache."""
+
+    with _lock:
+        return dict(_stats)
+
+
+def invalidate_current_user(user_id):
+    """Forget the cached record for `user_id` after it changes."""
+
+    with _lock:
+        _records.pop(user_id, None)
+
+
+def invalidate_after_commit(user_id):
+    """Forget the cached record for `user_id` once the current transaction commits."""
+
+    db.session.info.setdefault(PENDING_KEY, set()).add(user_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    for user_id in session.info.pop(PENDING_KEY, ()):
+        invalidate_current_user(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop(PENDING_KEY, None)
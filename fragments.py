@@ -0,0 +1,145 @@
+"""Cached rendering of message rows.
+
+Timelines, profiles and likes pages render the same message `<li>` over
+and over. `message_row` renders messages/row.html once per message and
+keeps the HTML in a worker-local LRU, bounded by FRAGMENT_CACHE_BYTES.
+The row is stored in two halves around its star, which is the only part
+that depends on the viewer and is filled in per request.
+
+Messages can't be edited, so a row only goes stale when its author's
+username or image changes; those are part of the key. So is the
+message's timestamp, in case ids are reused after the database is
+reseeded.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import g, render_template
+from markupsafe import Markup
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+# Stands in for the star while a row is rendered for the cache.
+STAR_PLACEHOLDER = '<!-- star -->'
+
+
+class FragmentCache:
+    """An LRU of rendered HTML, capped by total size, with hit counters.
+
+    `hits` and `misses` start again from zero on `clear()`; `total_hits`
+    and `total_misses` never do, for counters that mustn't go backwards.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.total_hits = 0
+        self.misses = self.total_misses = 0
+        self.evictions = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The fragment stored under `key`, or None."""
+
+        with self._lock:
+            entry = self._fragments.get(key)
+            if entry is None:
+                self.misses += 1
+                self.total_misses += 1
+                return None
+
+            self.hits += 1
+            self.total_hits += 1
+            self._fragments.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, fragment):
+        """Store `fragment` (a str or tuple of strs) under `key`."""
+
+        size = _size(fragment)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._fragments.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            self._fragments[key] = (fragment, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._fragments.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every fragment and reset the counters."""
+
+        with self._lock:
+            self._fragments.clear()
+            self.bytes = self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Counters for this worker's cache, including its hit rate."""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._fragments),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def _size(fragment):
+    """Bytes of HTML in `fragment` (its UTF-8 length)."""
+
+    parts = fragment if isinstance(fragment, tuple) else (fragment,)
+    return sum(len(part.encode('utf-8')) for part in parts)
+
+
+message_rows = FragmentCache()
+
+
+def configure_fragment_cache(app):
+    """Size the cache from FRAGMENT_CACHE_BYTES and expose `message_row`."""
+
+    message_rows.max_bytes = app.config.get('FRAGMENT_CACHE_BYTES', DEFAULT_MAX_BYTES)
+    app.jinja_env.globals['message_row'] = message_row
+
+
+_stars = {}
+
+
+def _star(liked):
+    if liked not in _stars:
+        _stars[liked] = render_template('messages/star.html', liked=liked)
+    return _stars[liked]
+
+
+def message_row(message, liked_ids):
+    """The `<li>` for `message`, with the star as the current viewer sees it."""
+
+    author = message.user
+    key = (message.id, message.timestamp, author.id, author.username, author.image_url)
+
+    halves = message_rows.get(key)
+    if halves is None:
+        html = render_template('messages/row.html', message=message,
+                               star=Markup(STAR_PLACEHOLDER))
+        halves = tuple(html.split(STAR_PLACEHOLDER, 1))
+        message_rows.set(key, halves)
+
+    if g.user and g.user.id == message.user_id:
+        star = ''
+    else:
+        star = _star(message.id in liked_ids)
+
+    return Markup(star.join(halves))
@@ -2,29 +2,59 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a benchmark dataset:
+
+    python generator/create_csvs.py                          # generator/*.csv
+    python generator/create_csvs.py --tier 100k --out /big   # then seed.py --data-dir /big
+
+Output is a function of the tier, --seed and --end alone: rows are built
+in fixed-size chunks, each from its own seeded random generator, so the
+files come out the same whatever --workers is. Chunks are built across a
+process pool and streamed to disk in order, and no step needs memory
+proportional to the dataset.
+
+Who gets followed, who posts and which messages get liked all follow a
+power law: a few users and messages get most of the attention. How many
+users each user follows, and how many messages they like, is exponential
+around the tier's average.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import io
+import os
+import random
+import sys
+from datetime import datetime
+from multiprocessing import Pool
+
+from helpers import Shuffle, get_random_datetime, paragraph, place, power_law_rank, sentence, WORDS
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+
+# (users, messages, follows, likes); follows and likes are approximate.
+TIERS = {
+    'sample': (300, 1000, 5000, 3000),
+    '1k': (1_000, 10_000, 20_000, 30_000),
+    '100k': (100_000, 1_000_000, 5_000_000, 3_000_000),
+    '10m': (10_000_000, 10_000_000, 50_000_000, 30_000_000),
+}
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# Rows (or, for follows and likes, users) per chunk of work.
+CHUNK_SIZE = 10_000
 
-fake = Faker()
+# Nobody follows or likes more than this many.
+MAX_PER_USER = 5_000
 
-# Generate random profile image URLs to use for users
+# "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+HEADER_IMAGE_URL = '/static/images/warbler-hero.jpg'
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +62,114 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def users_chunk(rng, start, stop, sizes, end):
+    for i in range(start, stop):
+        # The id suffix keeps usernames and emails unique.
+        username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{i}"
+        yield (f"{username}@example.com", username, rng.choice(image_urls), PASSWORD,
+               sentence(rng), HEADER_IMAGE_URL, place(rng))
+
+
+def messages_chunk(rng, start, stop, sizes, end):
+    num_users = sizes[0]
+    authors = Shuffle(num_users, offset=1)
+
+    for _ in range(start, stop):
+        yield (paragraph(rng, MAX_WARBLER_LENGTH),
+               get_random_datetime(rng, end),
+               authors(power_law_rank(rng, num_users)))
+
+
+def _picks(rng, num_targets, mean, target_ids, exclude=None):
+    """Distinct power-law picks from 1..num_targets, about `mean` of them."""
+
+    wanted = min(int(rng.expovariate(1 / mean)), MAX_PER_USER,
+                 num_targets - (exclude is not None))
+    picked = set()
+
+    # Popular targets come up over and over, so bound the attempts.
+    for _ in range(wanted * 4):
+        if len(picked) == wanted:
+            break
+        target = target_ids(power_law_rank(rng, num_targets))
+        if target != exclude:
+            picked.add(target)
+
+    return sorted(picked)
+
+
+def follows_chunk(rng, start, stop, sizes, end):
+    num_users, _, num_follows, _ = sizes
+    followed = Shuffle(num_users, offset=2)
+
+    for follower in range(start + 1, stop + 1):
+        for user_id in _picks(rng, num_users, num_follows / num_users, followed,
+                              exclude=follower):
+            yield (user_id, follower)
+
+
+def likes_chunk(rng, start, stop, sizes, end):
+    num_users, num_messages, _, num_likes = sizes
+    liked = Shuffle(num_messages, offset=3)
+
+    for user_id in range(start + 1, stop + 1):
+        for message_id in _picks(rng, num_messages, num_likes / num_users, liked):
+            yield (user_id, message_id)
+
+
+# table -> (headers, chunk builder, index of the size it's chunked over)
+TABLES = {
+    'users': (USERS_CSV_HEADERS, users_chunk, 0),
+    'messages': (MESSAGES_CSV_HEADERS, messages_chunk, 1),
+    'follows': (FOLLOWS_CSV_HEADERS, follows_chunk, 0),
+    'likes': (LIKES_CSV_HEADERS, likes_chunk, 0),
+}
+
+
+def build_chunk(task):
+    """CSV text for one chunk of one table."""
+
+    table, chunk, sizes, seed, end = task
+    _, builder, size_index = TABLES[table]
+    start = chunk * CHUNK_SIZE
+    stop = min(start + CHUNK_SIZE, sizes[size_index])
+
+    rng = random.Random(f"{seed}:{table}:{chunk}")
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerows(builder(rng, start, stop, sizes, end))
+    return out.getvalue()
+
+
+def generate(tier, seed, out_dir, end, workers):
+    """Write <out_dir>/<table>.csv for every table."""
+
+    sizes = TIERS[tier]
+    os.makedirs(out_dir, exist_ok=True)
+
+    with Pool(workers) as pool:
+        for table, (headers, _, size_index) in TABLES.items():
+            num_chunks = -(-sizes[size_index] // CHUNK_SIZE)
+            tasks = [(table, chunk, sizes, seed, end) for chunk in range(num_chunks)]
+            rows = 0
+
+            with open(os.path.join(out_dir, f'{table}.csv'), 'w', newline='') as file:
+                file.write(','.join(headers) + '\n')
+                for text in pool.imap(build_chunk, tasks):
+                    file.write(text)
+                    rows += text.count('\n')
+
+            print(f"{table}: {rows:,} rows", file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tier', choices=TIERS, default='sample')
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument('--end', type=datetime.fromisoformat, default=datetime(2021, 8, 1),
+                        help='newest possible message timestamp (ISO format)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+    generate(args.tier, args.seed, args.out, args.end, args.workers)
@@ -0,0 +1,154 @@
+"""HTTP cache policy for Warbler's responses.
+
+- Static files are served with `static_url(filename)`, which adds a hash
+  of the file's contents to the URL. Versioned URLs may be cached for a
+  year; anything else under /static for STATIC_MAX_AGE seconds.
+- Pages that go through `conditional_page` get an ETag (and
+  Last-Modified, where the page has a trustworthy one) and a matching
+  conditional GET is answered with 304 before the page is rendered.
+  Anonymous visitors' copies are `public, no-cache`, so browsers and the
+  reverse proxy keep a copy but revalidate each use. Pages whose
+  validators cover the viewer (the profile pages, via `User.version`)
+  are conditional for logged-in users too, as `private, no-cache`. Their
+  ETags also change with the CSRF token they render, and every half
+  WTF_CSRF_TIME_LIMIT, so a revalidated copy never holds an expired token.
+- Everything else is `private, no-cache`.
+"""
+
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+
+from flask import current_app, g, request, session, make_response, url_for
+from flask_wtf.csrf import generate_csrf
+
+VERSIONED_STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+STATIC_MAX_AGE = 60 * 60
+
+_static_hashes = {}
+_release = None
+
+
+def _file_digest(path):
+    with open(path, 'rb') as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+def static_url(filename):
+    """URL of a static file, versioned by its contents."""
+
+    if filename not in _static_hashes:
+        path = os.path.join(current_app.static_folder, filename)
+        _static_hashes[filename] = _file_digest(path)[:12]
+
+    return url_for('static', filename=filename, v=_static_hashes[filename])
+
+
+def release():
+    """(hash, mtime) of the templates and static files being served.
+
+    Part of every page's validators, so a deploy that changes how pages
+    render invalidates cached copies. The hash is of file contents, so
+    every worker computes the same one.
+    """
+
+    global _release
+
+    if _release is None:
+        digest = hashlib.md5()
+        newest = 0
+        for folder in (current_app.template_folder, current_app.static_folder):
+            root = os.path.join(current_app.root_path, folder)
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    path = os.path.join(dirpath, filename)
+                    digest.update(path[len(root):].encode('utf-8'))
+                    digest.update(_file_digest(path).encode('utf-8'))
+                    newest = max(newest, os.path.getmtime(path))
+        _release = (digest.hexdigest(),
+                    datetime.fromtimestamp(int(newest), timezone.utc))
+
+    return _release
+
+
+def _csrf_validators():
+    """The session's CSRF token, and which half-lifetime of it we're in."""
+
+    if not current_app.config.get('WTF_CSRF_ENABLED', True):
+        return None
+
+    # makes the session's token now if the page would have
+    generate_csrf()
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    window = int(time.time() // (limit / 2)) if limit else None
+    return session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')), window
+
+
+def conditional_page(validators, render, last_modified=None, per_viewer=False):
+    """Respond with `render()`, or 304 if the client's copy is current.
+
+    `validators` is anything whose repr changes whenever the rendered
+    page would; `last_modified` a UTC datetime no earlier than the last
+    change to anything on the page. Unless `per_viewer` (the validators
+    cover the logged-in user's own state), only anonymous requests are
+    conditional. Neither is while a flashed message is waiting to be
+    shown.
+    """
+
+    if '_flashes' in session or (g.user and not per_viewer):
+        return render()
+
+    release_hash, release_time = release()
+    # only logged-in pages render forms
+    csrf = _csrf_validators() if g.user else None
+    etag = hashlib.md5(
+        repr((release_hash, request.full_path, request.accept_mimetypes.best,
+              validators, csrf)).encode('utf-8')).hexdigest()
+    if last_modified is not None:
+        last_modified = max(last_modified.replace(tzinfo=timezone.utc), release_time)
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = (last_modified is not None
+                 and request.if_modified_since is not None
+                 and int(last_modified.timestamp()) <= request.if_modified_since.timestamp())
+
+    if fresh:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if g.user:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.cache_control.no_cache = True
+    response.vary.update(('Cookie', 'Accept'))
+    g.cache_policy_set = True
+
+    return response
+
+
+def apply_cache_policy(response):
+    """Default Cache-Control for responses that didn't set their own."""
+
+    if request.endpoint == 'static':
+        if request.args.get('v'):
+            response.cache_control.max_age = VERSIONED_STATIC_MAX_AGE
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            response.expires = int(time.time() + VERSIONED_STATIC_MAX_AGE)
+        return response
+
+    if not g.get('cache_policy_set'):
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    return response
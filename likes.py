@@ -0,0 +1,327 @@
+"""Liking and unliking messages.
+
+`toggle_like` flips a like in a single statement: the delete, the
+insert, the liker's `likes_count` and `version` (the same adjustments
+user_stats makes on the other write paths) and the message's new like
+count all happen in one round trip, as data-modifying CTEs.
+
+With LIKES_WRITE_BEHIND set, `toggle` instead records toggles in a
+per-worker `LikeBuffer` that writes them in bulk a moment later. Pages
+that show the current user's likes merge in `pending_for(user_id)`, so
+nobody sees their own like vanish while it waits. The buffer is flushed
+when the process exits.
+"""
+
+import atexit
+import os
+import threading
+from collections import Counter
+
+from sqlalchemy import Integer, bindparam, delete, func, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from current_user import invalidate_after_commit, invalidate_current_user
+from models import db, Like, Message, User
+
+DEFAULT_FLUSH_SIZE = 200
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+DEFAULT_MAX_PENDING = 2000
+
+# The write-behind buffer, when LIKES_WRITE_BEHIND is on.
+buffer = None
+
+
+def configure_likes(app):
+    """Set up write-behind likes if LIKES_WRITE_BEHIND is on."""
+
+    global buffer
+
+    if not app.config.get('LIKES_WRITE_BEHIND'):
+        buffer = None
+        return
+
+    buffer = LikeBuffer(
+        app,
+        flush_size=app.config.get('LIKES_FLUSH_SIZE', DEFAULT_FLUSH_SIZE),
+        flush_interval=app.config.get('LIKES_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+        max_pending=app.config.get('LIKES_MAX_PENDING', DEFAULT_MAX_PENDING),
+    )
+    atexit.register(buffer.close)
+
+
+def toggle(user_id, message_id):
+    """Toggle a like, through the buffer if write-behind is on.
+
+    Returns (liked, like_count), or None if there's no such message.
+    """
+
+    if buffer is not None:
+        return buffer.toggle(user_id, message_id)
+    return toggle_like(user_id, message_id)
+
+
+def pending_for(user_id):
+    """{message_id: liked} for `user_id`'s buffered, unwritten toggles."""
+
+    if buffer is None:
+        return {}
+    return buffer.pending_for(user_id)
+
+
+def toggle_like(user_id, message_id):
+    """Like `message_id` as `user_id`, or unlike it if it's already liked.
+
+    Returns (liked, like_count) as of the toggle, or None if there's no
+    such message. The caller commits.
+    """
+
+    removed = (delete(Like)
+               .where(Like.user_id == user_id, Like.message_id == message_id)
+               .returning(Like.message_id)
+               .cte('removed'))
+    num_removed = select(func.count()).select_from(removed).scalar_subquery()
+
+    # A concurrent toggle may have inserted the row already; then there's
+    # nothing to add and the message is liked either way.
+    added = (insert(Like)
+             .from_select(['user_id', 'message_id'],
+                          select(literal(user_id), Message.id)
+                          .where(Message.id == message_id)
+                          .where(~select(removed.c.message_id).exists()))
+             .on_conflict_do_nothing()
+             .returning(Like.message_id)
+             .cte('added'))
+    num_added = select(func.count()).select_from(added).scalar_subquery()
+
+    # Matches no row for a missing message, so the whole result is empty.
+    liker = (update(User)
+             .where(User.id == user_id,
+                    select(Message.id).where(Message.id == message_id).exists())
+             .values(likes_count=User.likes_count + num_added - num_removed,
+                     version=User.version + 1)
+             .returning(User.id)
+             .cte('liker'))
+
+    # Every part of the statement sees the likes from before it ran.
+    likes_before = (select(func.count())
+                    .select_from(Like)
+                    .where(Like.message_id == message_id)
+                    .scalar_subquery())
+
+    row = db.session.execute(
+        select((num_removed == 0).label('liked'),
+               (likes_before - num_removed + num_added).label('like_count'))
+        .select_from(liker)
+    ).first()
+
+    if row is None:
+        return None
+    invalidate_after_commit(user_id)
+    return row.liked, row.like_count
+
+
+class LikeBuffer:
+    """Write-behind buffer of like toggles for one worker process.
+
+    Each buffered (user, message) pair holds the state it had in the
+    database and the state it should end up in, so repeated toggles of a
+    pair collapse into one write, or none if they cancel out. A
+    background thread flushes the buffer every `flush_interval` seconds,
+    or sooner once `flush_size` pairs are waiting; a toggle that finds
+    `max_pending` pairs waiting flushes them itself.
+    """
+
+    def __init__(self, app, flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_pending=DEFAULT_MAX_PENDING):
+        self.app = app
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        # user_id -> {message_id: (liked_in_db, liked)}
+        self._pending = {}
+        # what the flush in progress is writing, still visible to readers
+        self._flushing = {}
+        self._size = 0
+        # message_id -> change to its like count once everything is written
+        self._count_changes = Counter()
+
+        self._closed = False
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+
+    def pending_for(self, user_id):
+        """{message_id: liked} for `user_id`'s toggles not yet written."""
+
+        with self._cond:
+            merged = {**self._flushing.get(user_id, {}), **self._pending.get(user_id, {})}
+        return {message_id: liked for message_id, (_, liked) in merged.items()}
+
+    def toggle(self, user_id, message_id):
+        """Buffer a toggle; returns (liked, like_count), or None, like toggle_like.
+
+        The like count includes this worker's buffered toggles.
+        """
+
+        row = db.session.execute(
+            select(select(Like.user_id)
+                   .where(Like.user_id == user_id, Like.message_id == message_id)
+                   .exists().label('liked'),
+                   select(func.count())
+                   .select_from(Like)
+                   .where(Like.message_id == message_id)
+                   .scalar_subquery().label('like_count'))
+            .where(select(Message.id).where(Message.id == message_id).exists())
+        ).first()
+        if row is None:
+            return None
+
+        with self._cond:
+            toggles = self._pending.setdefault(user_id, {})
+            if message_id in toggles:
+                liked_in_db, current = toggles.pop(message_id)
+                self._size -= 1
+                self._count_changes[message_id] -= current - liked_in_db
+            elif message_id in self._flushing.get(user_id, {}):
+                # the flush in progress will leave the pair in this state
+                liked_in_db = current = self._flushing[user_id][message_id][1]
+            else:
+                liked_in_db = current = row.liked
+
+            liked = not current
+            if liked != liked_in_db:
+                toggles[message_id] = (liked_in_db, liked)
+                self._size += 1
+                self._count_changes[message_id] += liked - liked_in_db
+
+            like_count = row.like_count + self._count_changes[message_id]
+            size = self._size
+            if size >= self.flush_size:
+                self._cond.notify()
+
+        self._start_flusher()
+        if size >= self.max_pending:
+            self.flush()
+
+        return liked, max(like_count, 0)
+
+    def _start_flusher(self):
+        """Start this process's flusher thread, if it isn't running."""
+
+        with self._cond:
+            if self._thread_pid == os.getpid() or self._closed:
+                return
+            self._thread = threading.Thread(target=self._run, name='like-flusher',
+                                            daemon=True)
+            self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._size < self.flush_size and not self._closed:
+                    self._cond.wait(self.flush_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Writing buffered likes failed')
+
+    def flush(self):
+        """Write every buffered toggle in one transaction, with executemany."""
+
+        with self._flush_lock:
+            with self._cond:
+                if not self._size:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                self._size = 0
+
+            pairs = [(user_id, message_id, liked_in_db, liked)
+                     for user_id, toggles in self._flushing.items()
+                     for message_id, (liked_in_db, liked) in toggles.items()]
+            added = [dict(uid=u, mid=m) for u, m, _, liked in pairs if liked]
+            removed = [dict(uid=u, mid=m) for u, m, _, liked in pairs if not liked]
+
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as conn:
+                        if added:
+                            conn.execute(_insert_like, added)
+                        if removed:
+                            conn.execute(_delete_like, removed)
+                        conn.execute(_recount_likes.where(User.id.in_(list(self._flushing))))
+            except Exception:
+                self._requeue()
+                raise
+
+            for user_id in self._flushing:
+                invalidate_current_user(user_id)
+
+            with self._cond:
+                for _, message_id, liked_in_db, liked in pairs:
+                    self._count_changes[message_id] -= liked - liked_in_db
+                    if not self._count_changes[message_id]:
+                        del self._count_changes[message_id]
+                self._flushing = {}
+
+    def _requeue(self):
+        """Put a failed flush's toggles back, unless toggled again since."""
+
+        with self._cond:
+            for user_id, toggles in self._flushing.items():
+                newer = self._pending.setdefault(user_id, {})
+                for message_id, (liked_in_db, liked) in toggles.items():
+                    if message_id not in newer:
+                        newer[message_id] = (liked_in_db, liked)
+                        self._size += 1
+                    elif newer[message_id][1] == liked_in_db:
+                        # toggled back: the two cancel out
+                        del newer[message_id]
+                        self._size -= 1
+                    else:
+                        # the newer toggle counted from this one's result
+                        newer[message_id] = (liked_in_db, newer[message_id][1])
+            self._flushing = {}
+
+    def close(self):
+        """Stop the flusher and write whatever is still buffered."""
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread if self._thread_pid == os.getpid() else None
+
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+
+# Run with a list of {uid, mid} parameter sets, as one executemany. Pairs
+# whose message or user was deleted after the toggle are skipped.
+_insert_like = (insert(Like)
+                .from_select(['user_id', 'message_id'],
+                             select(bindparam('uid', type_=Integer), Message.id)
+                             .where(Message.id == bindparam('mid'))
+                             .where(select(User.id)
+                                    .where(User.id == bindparam('uid'))
+                                    .exists()))
+                .on_conflict_do_nothing())
+
+_delete_like = (delete(Like)
+                .where(Like.user_id == bindparam('uid'),
+                       Like.message_id == bindparam('mid')))
+
+# Recounting, rather than adding up deltas, keeps the counts right even
+# if another worker toggled the same pairs in the meantime.
+_recount_likes = (update(User)
+                  .values(likes_count=select(func.count())
+                                      .select_from(Like)
+                                      .where(Like.user_id == User.id)
+                                      .scalar_subquery(),
+                          version=User.version + 1))
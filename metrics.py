@@ -0,0 +1,497 @@
+"""Prometheus metrics for Warbler, served at /metrics.
+
+- warbler_request_duration_seconds: a latency histogram per endpoint
+- warbler_requests_total: responses per endpoint and status code
+- warbler_request_db_seconds_total and _template_seconds_total: where
+  each endpoint's time went (template time includes any queries the
+  templates trigger)
+- warbler_db_pool_wait_seconds: how long checkouts waited for a pooled
+  connection (Postgres only, through `TimedQueuePool`)
+- warbler_cache_hits_total / _misses_total: the message row and
+  current-user caches
+
+Each process keeps its values in a memory map of fixed-size slots,
+one per label set, and only ever writes its own; an update is a couple
+of struct writes under a per-process lock. With METRICS_DIR set, the
+maps are files in that directory and /metrics sums every file, so a
+scrape of any gunicorn worker sees the whole server. When a worker
+starts, the files of processes that have exited are added into one
+totals file and deleted, under a lock that scrapes share, so totals
+never go backwards when a worker is replaced and the directory doesn't
+grow with every restart. Without METRICS_DIR, the maps are anonymous and
+each worker reports only itself.
+"""
+
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import (before_render_template, g, got_request_exception, request,
+                   template_rendered)
+from sqlalchemy.pool import QueuePool
+
+from current_user import cache_stats
+from fragments import message_rows
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+INITIAL_SIZE = 64 * 1024
+
+# Files under METRICS_DIR: one per process, named for its pid, plus the
+# merged values of processes that have exited.
+PROCESS_FILENAME = re.compile(r'warbler-(\d+)-[0-9a-f]+\.db')
+TOTALS_FILENAME = 'warbler-totals.db'
+LOCK_FILENAME = 'warbler.lock'
+
+# A map is the bytes used, then entries of: key length, key (padded so
+# the value is 8-byte aligned), value.
+_USED = struct.Struct('<Q')
+_KEY_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+def _entries(buffer):
+    """(key, value, value offset) for each entry in a map's bytes."""
+
+    used = _USED.unpack_from(buffer, 0)[0]
+    offset = _USED.size
+    while offset < used:
+        length = _KEY_LENGTH.unpack_from(buffer, offset)[0]
+        start = offset + _KEY_LENGTH.size
+        key = bytes(buffer[start:start + length]).decode('utf-8')
+        position = offset + _padded(length)
+        yield key, _VALUE.unpack_from(buffer, position)[0], position
+        offset = position + _VALUE.size
+
+
+def _padded(key_length):
+    return (_KEY_LENGTH.size + key_length + 7) // 8 * 8
+
+
+class ValueStore:
+    """Float values by key, in a memory map written only by this process."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._positions = {}
+        self._lock = threading.Lock()
+
+        if path:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            os.ftruncate(self._fd, INITIAL_SIZE)
+            self._map = mmap.mmap(self._fd, INITIAL_SIZE)
+        else:
+            self._fd = None
+            self._map = mmap.mmap(-1, INITIAL_SIZE)
+        _USED.pack_into(self._map, 0, _USED.size)
+        self._used = _USED.size
+
+    def _position(self, key):
+        """Offset of `key`'s value, adding a zero entry for a new key."""
+
+        position = self._positions.get(key)
+        if position is None:
+            encoded = key.encode('utf-8')
+            position = self._used + _padded(len(encoded))
+            if position + _VALUE.size > len(self._map):
+                self._grow(position + _VALUE.size)
+
+            _KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+            start = self._used + _KEY_LENGTH.size
+            self._map[start:start + len(encoded)] = encoded
+            _VALUE.pack_into(self._map, position, 0.0)
+
+            # readers stop at the used mark, so they never see half an entry
+            self._used = position + _VALUE.size
+            _USED.pack_into(self._map, 0, self._used)
+            self._positions[key] = position
+        return position
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+
+        if self._fd is None:
+            grown = mmap.mmap(-1, size)
+            grown[:len(self._map)] = self._map[:]
+        else:
+            os.ftruncate(self._fd, size)
+            grown = mmap.mmap(self._fd, size)
+        self._map.close()
+        self._map = grown
+
+    def inc(self, amounts):
+        """Add each (key, amount) in `amounts`."""
+
+        with self._lock:
+            for key, amount in amounts:
+                position = self._position(key)
+                value = _VALUE.unpack_from(self._map, position)[0]
+                _VALUE.pack_into(self._map, position, value + amount)
+
+    def set(self, values):
+        """Set each (key, value) in `values`."""
+
+        with self._lock:
+            for key, value in values:
+                _VALUE.pack_into(self._map, self._position(key), value)
+
+    def items(self):
+        with self._lock:
+            return [(key, value) for key, value, _ in _entries(self._map)]
+
+    def dump(self):
+        """The map's used bytes, as a file for `_read_values`."""
+
+        with self._lock:
+            return self._map[:self._used]
+
+
+_directory = None
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def store():
+    """This process's ValueStore (a new one after a fork)."""
+
+    global _store, _store_pid
+
+    if _store_pid != os.getpid():
+        with _store_lock:
+            if _store_pid != os.getpid():
+                path = None
+                if _directory:
+                    path = os.path.join(_directory,
+                                        f'warbler-{os.getpid()}-{uuid.uuid4().hex[:8]}.db')
+                _store = ValueStore(path)
+                _store_pid = os.getpid()
+    return _store
+
+
+def use_directory(directory):
+    """Keep this process's values, from now on, in a file under `directory`."""
+
+    global _directory, _store_pid
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        merge_exited(directory)
+    with _store_lock:
+        _directory = directory
+        _store_pid = None
+
+
+@contextmanager
+def _locked(directory, operation):
+    """Hold the directory's lock file, shared or exclusive, for the block."""
+
+    with open(os.path.join(directory, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_values(path):
+    """(key, value) for each entry in the map file at `path`."""
+
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return []
+    # a file its process has only just created is still empty
+    if len(data) < _USED.size:
+        return []
+    return [(key, value) for key, value, _ in _entries(data)]
+
+
+def _exited(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def merge_exited(directory):
+    """Add the files of exited processes into the totals file, and delete them."""
+
+    with _locked(directory, fcntl.LOCK_EX):
+        exited = []
+        for filename in os.listdir(directory):
+            match = PROCESS_FILENAME.fullmatch(filename)
+            if match and _exited(int(match.group(1))):
+                exited.append(os.path.join(directory, filename))
+        if not exited:
+            return
+
+        totals_path = os.path.join(directory, TOTALS_FILENAME)
+        totals = defaultdict(float, _read_values(totals_path))
+        for path in exited:
+            for key, value in _read_values(path):
+                totals[key] += value
+
+        merged = ValueStore()
+        merged.set(totals.items())
+        with open(f'{totals_path}.new', 'wb') as file:
+            file.write(merged.dump())
+        os.replace(f'{totals_path}.new', totals_path)
+
+        for path in exited:
+            os.remove(path)
+
+
+def _totals():
+    """Every key's value summed over this server's processes."""
+
+    if not _directory:
+        return dict(store().items())
+
+    totals = defaultdict(float)
+    with _locked(_directory, fcntl.LOCK_SH):
+        for filename in os.listdir(_directory):
+            if filename.endswith('.db'):
+                for key, value in _read_values(os.path.join(_directory, filename)):
+                    totals[key] += value
+    return totals
+
+
+registry = []
+
+
+class Metric:
+    """A named family of samples, one per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._keys = {}
+        registry.append(self)
+
+    def key(self, labels, field):
+        """The store key for `field` of the sample with these label values."""
+
+        key = self._keys.get((labels, field))
+        if key is None:
+            key = self._keys[(labels, field)] = json.dumps([self.name, labels, field])
+        return key
+
+    def samples(self, labels, fields):
+        """(name, labels, value) to expose for one label set's {field: value}."""
+
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1.0):
+        store().inc([(self.key(labels, 'value'), amount)])
+
+    def samples(self, labels, fields):
+        yield self.name, labels, fields.get('value', 0.0)
+
+
+class CollectedCounter(Counter):
+    """A counter kept elsewhere, copied into the store by `collect()`.
+
+    `source()` returns {label values: running total} for this process.
+    """
+
+    def __init__(self, name, help, labelnames, source):
+        super().__init__(name, help, labelnames)
+        self.source = source
+
+    def collect(self):
+        store().set([(self.key(labels, 'value'), value)
+                     for labels, value in self.source().items()])
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self._bounds = [_format(bound) for bound in self.buckets] + ['+Inf']
+
+    def observe(self, labels, value):
+        bound = self._bounds[bisect.bisect_left(self.buckets, value)]
+        store().inc([(self.key(labels, bound), 1.0),
+                     (self.key(labels, 'sum'), value),
+                     (self.key(labels, 'count'), 1.0)])
+
+    def samples(self, labels, fields):
+        # buckets are stored separately; exposition wants them cumulative
+        running = 0.0
+        for bound in self._bounds:
+            running += fields.get(bound, 0.0)
+            yield f'{self.name}_bucket', labels + (('le', bound),), running
+        yield f'{self.name}_sum', labels, fields.get('sum', 0.0)
+        yield f'{self.name}_count', labels, fields.get('count', 0.0)
+
+
+def _format(value):
+    return repr(float(value)) if value != int(value) else f'{int(value)}.0'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def collect():
+    """Copy this process's collected counters into its store."""
+
+    for metric in registry:
+        if isinstance(metric, CollectedCounter):
+            metric.collect()
+
+
+def render():
+    """Every metric in Prometheus text format."""
+
+    collect()
+
+    by_metric = defaultdict(lambda: defaultdict(dict))
+    for key, value in _totals().items():
+        name, labels, field = json.loads(key)
+        by_metric[name][tuple(labels)][field] = value
+
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for labels, fields in sorted(by_metric[metric.name].items()):
+            pairs = tuple(zip(metric.labelnames, labels))
+            for name, sample_labels, value in metric.samples(pairs, fields):
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in sample_labels)
+                lines.append(f'{name}{{{label_text}}} {value!r}' if label_text
+                             else f'{name} {value!r}')
+    return '\n'.join(lines) + '\n'
+
+
+def _cache_counts(field):
+    def source():
+        return {('message_rows',): getattr(message_rows, f'total_{field}'),
+                ('current_user',): cache_stats()[field]}
+    return source
+
+
+request_duration = Histogram(
+    'warbler_request_duration_seconds', 'Time to handle a request.', ('endpoint',))
+
+requests_total = Counter(
+    'warbler_requests_total', 'Responses sent.', ('endpoint', 'status'))
+
+request_db_seconds = Counter(
+    'warbler_request_db_seconds_total', 'Time spent running SQL statements.', ('endpoint',))
+
+request_template_seconds = Counter(
+    'warbler_request_template_seconds_total',
+    'Time spent rendering templates, including queries they trigger.', ('endpoint',))
+
+pool_wait = Histogram(
+    'warbler_db_pool_wait_seconds', 'Time a checkout waited for a pooled connection.',
+    buckets=POOL_WAIT_BUCKETS)
+
+cache_hits = CollectedCounter(
+    'warbler_cache_hits_total', 'Cache lookups that found an entry.', ('cache',),
+    _cache_counts('hits'))
+
+cache_misses = CollectedCounter(
+    'warbler_cache_misses_total', 'Cache lookups that missed.', ('cache',),
+    _cache_counts('misses'))
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout waits."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.observe((), time.perf_counter() - started)
+
+
+def _template_started(app, template, context):
+    if g.get('template_depth', 0) == 0:
+        g.template_started = time.perf_counter()
+    g.template_depth = g.get('template_depth', 0) + 1
+
+
+def _template_finished(app, template, context):
+    g.template_depth -= 1
+    # templates rendered inside another (such as cached message rows)
+    # are already part of its time
+    if g.template_depth == 0:
+        g.template_seconds = (g.get('template_seconds', 0.0)
+                              + time.perf_counter() - g.template_started)
+
+
+def configure_metrics(app):
+    """Time every request to `app`, keeping values under METRICS_DIR if set."""
+
+    use_directory(app.config.get('METRICS_DIR'))
+
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        _record_request(response.status_code)
+        return response
+
+    # Requests whose exception escapes their handler may never reach the
+    # after_request hook, so count them here, before the teardown hooks
+    # drop their SQL stats.
+    got_request_exception.connect(_record_failed_request, app)
+
+
+def _record_failed_request(app, exception, **extra):
+    _record_request(500)
+
+
+def _record_request(status_code):
+    """Record the current request, unless it already has been."""
+
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+
+    endpoint = (request.endpoint or 'unmatched',)
+    request_duration.observe(endpoint, time.perf_counter() - started)
+    requests_total.inc(endpoint + (str(status_code),))
+
+    stats = g.get('sql_stats')
+    if stats is not None:
+        request_db_seconds.inc(endpoint, stats.db_seconds)
+    request_template_seconds.inc(endpoint, g.get('template_seconds', 0.0))
+    collect()
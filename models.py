@@ -2,11 +2,14 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, func
+from sqlalchemy.orm import selectinload
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hash_password, check_password, needs_rehash
+from replicas import RoutingSQLAlchemy
+
+# Reads on GET requests may go to a replica; see replicas.py.
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -14,6 +17,12 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key leads with the followed user; this finds who a user follows.
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id',
+                 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -32,6 +41,23 @@ class User(db.Model):
 
     __tablename__ = 'users'
 
+    # Indexes behind search.py: trigram indexes for substring matches and a
+    # pattern index on lower(username) for prefix matches.
+    __table_args__ = (
+        db.Index('ix_users_username_trgm', 'username',
+                 postgresql_using='gin',
+                 postgresql_ops={'username': 'gin_trgm_ops'}),
+        db.Index('ix_users_location_trgm', 'location',
+                 postgresql_using='gin',
+                 postgresql_ops={'location': 'gin_trgm_ops'}),
+        db.Index('ix_users_bio_trgm', 'bio',
+                 postgresql_using='gin',
+                 postgresql_ops={'bio': 'gin_trgm_ops'}),
+        db.Index('ix_users_username_lower_pattern',
+                 func.lower(db.text('username')).label('username_lower'),
+                 postgresql_ops={'username_lower': 'text_pattern_ops'}),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -72,7 +98,60 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', order_by='Message.timestamp.desc()')
+    # Denormalized counts for the stats cards, maintained by user_stats.py
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Whether this user's messages are merged into their followers'
+    # timelines on read instead of pushed; see timelines.py.
+    timeline_pulled = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # Bumped by user_stats.py whenever anything shown on this user's
+    # profile, following, followers or likes pages changes; see
+    # http_cache.py for the ETags built from it.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    messages = db.relationship(
+        'Message',
+        order_by='Message.timestamp.desc()',
+        cascade="all, delete",
+        passive_deletes=True,
+    )
 
     liked_messages = db.relationship('Message', secondary="likes", backref='liked_by')
 
@@ -96,14 +175,48 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query.filter_by(user_being_followed_id=self.id,
+                                    user_following_id=other_user.id).exists()
+        ).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query.filter_by(user_following_id=self.id,
+                                    user_being_followed_id=other_user.id).exists()
+        ).scalar()
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Returns a set, fetched in one query, so a grid of user cards can
+        check each follow button with a set lookup.
+        """
+
+        if not user_ids:
+            return set()
+
+        followed = (db.session.query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id)
+                    .filter(Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for user_id, in followed}
+
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Returns a set, fetched in one query, so a rendered timeline can
+        check each message's star without loading any `liked_by` lists.
+        """
+
+        if not message_ids:
+            return set()
+
+        liked = (db.session.query(Like.message_id)
+                 .filter(Like.user_id == self.id)
+                 .filter(Like.message_id.in_(message_ids)))
+        return {message_id for message_id, in liked}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -112,7 +225,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(    
             username=username,
@@ -133,13 +246,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash uses an outdated work factor it is replaced with
+        a fresh hash; the caller's commit saves it.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
                 return user
 
         return False
@@ -150,6 +268,10 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -176,14 +298,24 @@ class Message(db.Model):
 
     def is_liked_by(self, user):
         '''Is this message liked by this user'''
-        liked_user_list = [liked_by_user for liked_by_user in self.liked_by if user == liked_by_user]
-        return len(liked_user_list) == 1
+
+        if user is None:
+            return False
+
+        return db.session.query(
+            Like.query.filter_by(user_id=user.id, message_id=self.id).exists()
+        ).scalar()
 
 class Like(db.Model):
     '''Likes'''
 
     __tablename__ = 'likes'
 
+    # The primary key leads with the liker; this counts a message's likes.
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -196,6 +328,60 @@ class Like(db.Model):
         primary_key=True,
     )
 
+
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'),
+)
+
+# Full-text index behind search.search_messages. Declared as DDL because the
+# expression only exists on Postgres.
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE INDEX ix_messages_text_fts ON messages "
+        "USING gin (to_tsvector('english'::regconfig, text))"
+        ).execute_if(dialect='postgresql'),
+)
+
+
+# Loader option for lists of messages: every author on the page is fetched
+# in one extra SELECT ... WHERE id IN (...), limited to the columns a
+# message row renders, instead of one lazy load per author.
+with_message_authors = selectinload(Message.user).load_only(
+    User.id, User.username, User.image_url)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp', 'user_id', 'timestamp'),
+        # for removing a deleted message from every timeline
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,81 @@
+"""Keyset (cursor) pagination for Warbler's message and user lists.
+
+Messages are paged newest first on (timestamp, id); users are paged in
+id order. A page is fetched with one indexed range scan no matter how
+far into the list it is, unlike OFFSET paging.
+"""
+
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import tuple_
+
+from models import Message, User
+
+MESSAGES_PER_PAGE = 20
+USERS_PER_PAGE = 24
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_message_cursor(message):
+    """Opaque cursor pointing just past `message`."""
+
+    key = f"{message.timestamp.isoformat()},{message.id}"
+    return urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_message_cursor(cursor):
+    """(timestamp, id) from a message cursor; 400s on a malformed one."""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, message_id = urlsafe_b64decode(padded).decode().split(',')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        abort(400)
+
+
+def decode_user_cursor(cursor):
+    """User id from a user cursor; 400s on a malformed one."""
+
+    try:
+        return int(cursor)
+    except ValueError:
+        abort(400)
+
+
+def paginate_messages(query, cursor=None, per_page=MESSAGES_PER_PAGE):
+    """One page of `query`'s messages, newest first, after `cursor`."""
+
+    if cursor:
+        timestamp, message_id = decode_message_cursor(cursor)
+        query = query.filter(
+            tuple_(Message.timestamp, Message.id) < tuple_(timestamp, message_id))
+
+    messages = (query
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(per_page + 1)
+                .all())
+
+    if len(messages) > per_page:
+        return Page(messages[:per_page], encode_message_cursor(messages[per_page - 1]))
+
+    return Page(messages, None)
+
+
+def paginate_users(query, cursor=None, per_page=USERS_PER_PAGE):
+    """One page of `query`'s users, in id order, after `cursor`."""
+
+    if cursor:
+        query = query.filter(User.id > decode_user_cursor(cursor))
+
+    users = query.order_by(User.id).limit(per_page + 1).all()
+
+    if len(users) > per_page:
+        return Page(users[:per_page], str(users[per_page - 1].id))
+
+    return Page(users, None)
@@ -0,0 +1,178 @@
+"""Password hashing for Warbler, off the request threads.
+
+bcrypt is deliberately slow, so a burst of logins or signups could take
+every CPU a worker has. Hashes and checks run in a small process pool per
+worker, at lower CPU priority, and at most `BCRYPT_MAX_CONCURRENT` may be
+running or queued at once. A request that can't get a slot within
+`BCRYPT_QUEUE_TIMEOUT` seconds gets `PasswordHashingBusy`.
+
+The work factor is `BCRYPT_LOG_ROUNDS`. Hashes made with a different
+factor are reported by `needs_rehash`, so they can be upgraded on the
+next successful login.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+DEFAULT_LOG_ROUNDS = 12
+
+DEFAULT_POOL_SIZE = max(1, (os.cpu_count() or 2) // 2)
+
+DEFAULT_QUEUE_TIMEOUT = 5.0
+
+# Niceness of the hashing processes, so request handling wins the CPU.
+POOL_NICENESS = 10
+
+
+class PasswordHashingBusy(Exception):
+    """Too many password hashes are already running or queued."""
+
+
+class _Settings:
+    log_rounds = DEFAULT_LOG_ROUNDS
+    pool_size = DEFAULT_POOL_SIZE
+    max_concurrent = DEFAULT_POOL_SIZE * 2
+    queue_timeout = DEFAULT_QUEUE_TIMEOUT
+
+
+settings = _Settings()
+
+_slots = threading.BoundedSemaphore(settings.max_concurrent)
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    'hashes': 0,
+    'checks': 0,
+    'rejected': 0,
+    'in_flight': 0,
+    'queue_seconds_total': 0.0,
+    'queue_seconds_max': 0.0,
+    'work_seconds_total': 0.0,
+}
+
+
+def configure_hashing(app):
+    """Read the BCRYPT_* settings from `app.config`.
+
+    BCRYPT_POOL_SIZE of 0 hashes on the request thread instead of a pool.
+    """
+
+    global _slots
+
+    settings.log_rounds = app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+    settings.pool_size = app.config.get('BCRYPT_POOL_SIZE', DEFAULT_POOL_SIZE)
+    settings.max_concurrent = app.config.get('BCRYPT_MAX_CONCURRENT',
+                                             max(settings.pool_size, 1) * 2)
+    settings.queue_timeout = app.config.get('BCRYPT_QUEUE_TIMEOUT',
+                                            DEFAULT_QUEUE_TIMEOUT)
+    _slots = threading.BoundedSemaphore(settings.max_concurrent)
+
+
+def hashing_stats():
+    """Counters and queue-time totals for this worker's password hashing."""
+
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _lower_priority():
+    os.nice(POOL_NICENESS)
+
+
+def _get_pool():
+    """This process's hashing pool (rebuilt after a fork)."""
+
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=settings.pool_size,
+                                        initializer=_lower_priority)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _timed_hash(password, rounds):
+    start = time.perf_counter()
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+    return hashed, time.perf_counter() - start
+
+
+def _timed_check(password, hashed):
+    start = time.perf_counter()
+    matches = bcrypt.checkpw(password, hashed)
+    return matches, time.perf_counter() - start
+
+
+def _run(kind, fn, *args):
+    """Run `fn(*args)` under the concurrency cap, recording its timings."""
+
+    queued = time.perf_counter()
+
+    if not _slots.acquire(timeout=settings.queue_timeout):
+        with _stats_lock:
+            _stats['rejected'] += 1
+        raise PasswordHashingBusy()
+
+    try:
+        with _stats_lock:
+            _stats['in_flight'] += 1
+
+        if settings.pool_size > 0:
+            future = _get_pool().submit(fn, *args)
+            result, work_seconds = future.result()
+        else:
+            result, work_seconds = fn(*args)
+    finally:
+        _slots.release()
+        with _stats_lock:
+            _stats['in_flight'] -= 1
+
+    queue_seconds = max(time.perf_counter() - queued - work_seconds, 0.0)
+
+    with _stats_lock:
+        _stats[kind] += 1
+        _stats['queue_seconds_total'] += queue_seconds
+        _stats['queue_seconds_max'] = max(_stats['queue_seconds_max'], queue_seconds)
+        _stats['work_seconds_total'] += work_seconds
+
+    return result
+
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+def hash_password(password):
+    """bcrypt hash of `password` at the configured work factor, as text."""
+
+    if not password:
+        raise ValueError('Password must be non-empty.')
+
+    hashed = _run('hashes', _timed_hash, _to_bytes(password), settings.log_rounds)
+    return hashed.decode('utf-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    if not password:
+        return False
+
+    return _run('checks', _timed_check, _to_bytes(password), _to_bytes(hashed))
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with a work factor other than the configured one?"""
+
+    try:
+        return int(hashed.split('$')[2]) != settings.log_rounds
+    except (IndexError, ValueError):
+        return True
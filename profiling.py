@@ -0,0 +1,161 @@
+"""Opt-in stack sampling of real requests, for flamegraphs.
+
+A request is profiled if it's one of the PROFILE_SAMPLE_RATE fraction
+picked at random, or if it carries a `X-Profile-Token` header signed
+with PROFILE_SECRET (get one with `flask profile-token`). Both are off
+by default, and then each request costs a config lookup and a header
+check.
+
+While a profiled request runs, a background thread records its thread's
+stack every PROFILE_INTERVAL seconds. When the request ends, the thread
+writes the stacks to PROFILE_DIR in collapsed format, one
+`frame;frame;... count` line per distinct stack, ready for
+flamegraph.pl or speedscope; the response names the file in an
+`X-Profile` header. At most PROFILE_MAX_CONCURRENT requests per worker
+are profiled at once.
+"""
+
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+
+import click
+from flask import g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+HEADER = 'X-Profile-Token'
+
+DEFAULT_INTERVAL = 0.005
+
+DEFAULT_MAX_CONCURRENT = 2
+
+# Seconds a signed profiling token stays valid.
+TOKEN_MAX_AGE = 60 * 60
+
+_running = weakref.WeakSet()
+_sequence = itertools.count()
+
+
+def _serializer(secret):
+    return URLSafeTimedSerializer(secret, salt='warbler-profile')
+
+
+def profile_token(secret):
+    """A token that, sent as the X-Profile-Token header, profiles a request."""
+
+    return _serializer(secret).dumps('profile')
+
+
+def _frame_name(code):
+    filename = code.co_filename
+    if filename.startswith(sys.prefix):
+        filename = os.path.basename(filename)
+    else:
+        filename = os.path.relpath(filename)
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class Sampler(threading.Thread):
+    """Samples one thread's stack until stopped, then writes the stacks to `path`."""
+
+    def __init__(self, thread_id, path, root, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.path = path
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            names.append(self.root)
+            self.stacks[';'.join(reversed(names))] += 1
+
+        with open(self.path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def wait(timeout=None):
+    """Wait for the profiles still being taken or written."""
+
+    for sampler in list(_running):
+        sampler.join(timeout)
+
+
+def configure_profiling(app):
+    """Sample the requests chosen by PROFILE_SAMPLE_RATE or a signed header."""
+
+    slots = threading.BoundedSemaphore(
+        app.config.get('PROFILE_MAX_CONCURRENT', DEFAULT_MAX_CONCURRENT))
+
+    def wanted():
+        rate = app.config.get('PROFILE_SAMPLE_RATE')
+        if rate and random.random() < rate:
+            return True
+
+        token = request.headers.get(HEADER)
+        secret = app.config.get('PROFILE_SECRET')
+        if not (token and secret):
+            return False
+        try:
+            _serializer(secret).loads(token, max_age=TOKEN_MAX_AGE)
+        except BadSignature:
+            return False
+        return True
+
+    @app.before_request
+    def start_profile():
+        if not wanted() or not slots.acquire(blocking=False):
+            return
+
+        directory = app.config.get('PROFILE_DIR', 'profiles')
+        os.makedirs(directory, exist_ok=True)
+        root = request.endpoint or 'unmatched'
+        filename = (f'{root}-{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-'
+                    f'{next(_sequence)}.collapsed')
+
+        g.profile_sampler = Sampler(threading.get_ident(), os.path.join(directory, filename),
+                                    root, app.config.get('PROFILE_INTERVAL', DEFAULT_INTERVAL))
+        g.profile_sampler.start()
+        _running.add(g.profile_sampler)
+
+    @app.after_request
+    def name_profile(response):
+        sampler = g.get('profile_sampler')
+        if sampler is not None:
+            response.headers['X-Profile'] = os.path.basename(sampler.path)
+        return response
+
+    @app.teardown_request
+    def stop_profile(exc):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is not None:
+            sampler.stop()
+            slots.release()
+
+    @app.cli.command('profile-token')
+    def profile_token_command():
+        """Print a token that profiles requests sent with X-Profile-Token."""
+
+        secret = app.config.get('PROFILE_SECRET')
+        if not secret:
+            raise click.UsageError('Set PROFILE_SECRET first.')
+        click.echo(profile_token(secret))
@@ -0,0 +1,54 @@
+"""In-process token-bucket rate limiting.
+
+Used by /login to turn away credential-stuffing bursts before they reach
+bcrypt. Each key (a username or a client address) gets a bucket of
+`capacity` tokens that refills at `rate` tokens per second; a request
+spends one token or is rejected. Buckets are shared by all of a worker's
+threads, and only the `max_keys` most recently used are kept.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_KEYS = 10000
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets with LRU eviction."""
+
+    def __init__(self, rate, capacity, max_keys=DEFAULT_MAX_KEYS):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Spend a token for `key`; False if its bucket is empty."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            # re-inserting moves the key to the most-recently-used end
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return allowed
+
+    def clear(self):
+        """Forget every bucket."""
+
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,220 @@
+"""Read replicas for GET traffic.
+
+Each name in REPLICA_BINDS is an SQLALCHEMY_BINDS entry for a read-only
+copy of the database (app.py makes them from DATABASE_REPLICA_URLS).
+Sessions are `RoutingSession`s, which send reads to a replica when:
+
+- the request is a GET or HEAD, so never from the CLI, background
+  threads or other methods;
+- the request hasn't written anything yet: a flush or an INSERT, UPDATE
+  or DELETE goes to the primary, and so does every later statement in
+  the request;
+- the client hasn't written in the last REPLICA_PIN_SECONDS, so that
+  it reads its own writes on the page it's redirected to. Keep this
+  above REPLICA_MAX_LAG.
+
+Each request sticks to one replica, picked round robin from the healthy
+ones. A background thread checks every replica each
+REPLICA_CHECK_INTERVAL seconds. A replica is skipped until its next good
+check if it fails a check, drops a connection, or replays more than
+REPLICA_MAX_LAG seconds behind the primary. With no healthy replica,
+reads go to the primary.
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm, text
+
+DEFAULT_MAX_LAG = 2.0
+
+DEFAULT_CHECK_INTERVAL = 5.0
+
+DEFAULT_PIN_SECONDS = 5.0
+
+READ_METHODS = frozenset(['GET', 'HEAD'])
+
+# Session key holding the time until which the client reads from the primary.
+PIN_KEY = '_read_primary_until'
+
+# Seconds since the last replayed transaction, or 0 if the replica has
+# replayed everything it has received (an idle primary sends nothing) or
+# isn't a standby at all.
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+logger = logging.getLogger(__name__)
+
+# The replica router, when REPLICA_BINDS names any.
+router = None
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with RoutingSession sessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from a replica where it safely can."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or getattr(clause, 'is_dml', False):
+            pin_to_primary()
+        elif router is not None and _reads_from_replica():
+            engine = _request_replica()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+def pin_to_primary():
+    """Send the rest of this request's reads, and the client's next ones, to the primary."""
+
+    if has_request_context():
+        g.read_primary = True
+
+
+def _reads_from_replica():
+    return (has_request_context()
+            and request.method in READ_METHODS
+            and not g.get('read_primary')
+            and session.get(PIN_KEY, 0) < time.time())
+
+
+def _request_replica():
+    if 'replica_engine' not in g:
+        g.replica_engine = router.choose()
+    return g.replica_engine
+
+
+class Replica:
+    """One replica bind and what its last check found."""
+
+    def __init__(self, name):
+        self.name = name
+        self.healthy = False
+        self.lag = None
+        self.error = None
+        self.checked_at = None
+
+
+class ReplicaRouter:
+    """Picks replicas round robin, and checks them in the background."""
+
+    def __init__(self, app, names, max_lag=DEFAULT_MAX_LAG,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.app = app
+        self.db = app.extensions['sqlalchemy'].db
+        self.replicas = [Replica(name) for name in names]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+        self._watched = set()
+        self._thread_pid = None
+        self._stopped = threading.Event()
+
+    def engine(self, replica):
+        engine = self.db.get_engine(self.app, bind=replica.name)
+        if replica.name not in self._watched:
+            self._watched.add(replica.name)
+
+            @event.listens_for(engine, 'handle_error')
+            def drop_on_disconnect(context):
+                if context.is_disconnect:
+                    replica.healthy = False
+                    replica.error = 'Connection lost.'
+
+        return engine
+
+    def choose(self):
+        """The next healthy replica's engine, or None to use the primary."""
+
+        self._start_checker()
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return self.engine(healthy[next(self._turns) % len(healthy)])
+
+    def check(self):
+        """Check every replica's connection and lag now."""
+
+        for replica in self.replicas:
+            was_healthy = replica.healthy
+            try:
+                with self.engine(replica).connect() as conn:
+                    if conn.dialect.name == 'postgresql':
+                        lag = float(conn.execute(LAG_QUERY).scalar())
+                    else:
+                        conn.execute(text('SELECT 1'))
+                        lag = 0.0
+            except Exception as exc:
+                replica.healthy = False
+                replica.error = f'{type(exc).__name__}: {exc}'
+            else:
+                replica.lag = lag
+                replica.healthy = lag <= self.max_lag
+                replica.error = None if replica.healthy else f'{lag:.1f}s behind'
+            replica.checked_at = time.time()
+
+            if was_healthy and not replica.healthy:
+                logger.warning('replica %s is out of rotation: %s', replica.name, replica.error)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _start_checker(self):
+        """Start this process's checker thread, if it isn't running."""
+
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='replica-checker', daemon=True).start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.check()
+            self._stopped.wait(self.check_interval)
+
+
+def configure_replicas(app):
+    """Read from the replicas in REPLICA_BINDS, if any, for GET requests to `app`."""
+
+    global router
+
+    if router is not None:
+        router.stop()
+
+    names = app.config.get('REPLICA_BINDS')
+    if not names:
+        router = None
+    else:
+        router = ReplicaRouter(
+            app, names,
+            max_lag=app.config.get('REPLICA_MAX_LAG', DEFAULT_MAX_LAG),
+            check_interval=app.config.get('REPLICA_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL))
+
+    if 'replicas' in app.extensions:
+        return
+    app.extensions['replicas'] = True
+
+    @app.after_request
+    def pin_writers(response):
+        if router is not None and (request.method not in READ_METHODS
+                                   or g.get('read_primary')):
+            session[PIN_KEY] = time.time() + app.config.get('REPLICA_PIN_SECONDS',
+                                                            DEFAULT_PIN_SECONDS)
+        return response
@@ -0,0 +1,164 @@
+"""Ranked user and message search.
+
+User search (/users?q=...): matches are ranked exact username, then username prefix, then username
+substring, then location or bio substring; shorter usernames come first
+within a rank. On Postgres, substring matches use the pg_trgm GIN indexes
+on users and prefix matches use the lower(username) pattern index, so no
+search has to scan the whole table.
+
+Results are lightweight rows holding only what a user card renders, paged
+on (rank, username length, id).
+
+Message search (/messages/search): Postgres full-text search over
+`Message.text`, served by the GIN index on to_tsvector('english', text).
+Postgres maintains that index as messages are added and deleted, so
+results are current as soon as messages_add or messages_destroy commits.
+Results are ranked by ts_rank and paged on (rank, id).
+"""
+
+from flask import abort
+from sqlalchemy import Float, case, cast, func, literal_column, or_, tuple_
+
+from models import db, User, Message, with_message_authors
+from pagination import Page, USERS_PER_PAGE, MESSAGES_PER_PAGE
+
+# Shorter terms can't use the trigram indexes, so they match prefixes only.
+MIN_SUBSTRING_TERM = 3
+
+MAX_TERM_LENGTH = 50
+
+# Searches stop paging after this many results.
+MAX_SEARCH_RESULTS = USERS_PER_PAGE * 10
+
+
+def _escape_like(term):
+    """Escape LIKE wildcards so `term` matches literally."""
+
+    return (term.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def _decode_cursor(cursor):
+    """(rank, length, id, served) from a search cursor; 400s on a bad one."""
+
+    try:
+        rank, length, user_id, served = (int(part) for part in cursor.split(','))
+        return rank, length, user_id, served
+    except ValueError:
+        abort(400)
+
+
+def search_users(term, cursor=None, per_page=USERS_PER_PAGE):
+    """One page of users matching `term`, best matches first."""
+
+    term = term.strip().lower()[:MAX_TERM_LENGTH]
+    escaped = _escape_like(term)
+
+    username = func.lower(User.username)
+    is_prefix = username.like(f"{escaped}%", escape='\\')
+    contains = f"%{escaped}%"
+
+    rank = case(
+        (username == term, 0),
+        (is_prefix, 1),
+        (username.like(contains, escape='\\'), 2),
+        else_=3,
+    )
+    length = func.length(User.username)
+
+    if len(term) < MIN_SUBSTRING_TERM:
+        matches = is_prefix
+    else:
+        matches = or_(User.username.ilike(contains, escape='\\'),
+                      User.location.ilike(contains, escape='\\'),
+                      User.bio.ilike(contains, escape='\\'))
+
+    query = (db.session.query(User.id,
+                              User.username,
+                              User.image_url,
+                              User.header_image_url,
+                              User.bio,
+                              rank.label('rank'),
+                              length.label('length'))
+             .filter(matches))
+
+    served = 0
+    if cursor:
+        *position, served = _decode_cursor(cursor)
+        query = query.filter(tuple_(rank, length, User.id) > tuple_(*position))
+
+    limit = min(per_page, MAX_SEARCH_RESULTS - served)
+    if limit <= 0:
+        return Page([], None)
+
+    users = (query
+             .order_by(rank, length, User.id)
+             .limit(limit + 1)
+             .all())
+
+    served += limit
+    if len(users) > limit and served < MAX_SEARCH_RESULTS:
+        last = users[limit - 1]
+        return Page(users[:limit], f"{last.rank},{last.length},{last.id},{served}")
+
+    return Page(users[:limit], None)
+
+
+# Must match the expression of the ix_messages_text_fts index in models.py.
+TEXT_SEARCH_CONFIG = literal_column("'english'::regconfig")
+
+
+def _decode_message_cursor(cursor):
+    """(rank, id) from a message search cursor; 400s on a bad one."""
+
+    try:
+        rank, message_id = cursor.split(',')
+        return float(rank), int(message_id)
+    except ValueError:
+        abort(400)
+
+
+def search_messages(terms, author=None, since=None, until=None,
+                    cursor=None, per_page=MESSAGES_PER_PAGE):
+    """One page of messages matching `terms`, most relevant first.
+
+    `terms` uses web search syntax ("quoted phrases", or, -excluded).
+    Optionally limited to messages by the user named `author` and to
+    messages posted on or after `since` and before `until` (datetimes).
+    Returns a Page of (message, rank) rows.
+    """
+
+    document = func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)
+    query_vector = func.websearch_to_tsquery(TEXT_SEARCH_CONFIG, terms)
+    # ts_rank is a real; as a double its value survives the round trip
+    # through the cursor exactly, so ties compare equal on the next page.
+    rank = cast(func.ts_rank(document, query_vector), Float(53))
+
+    query = (db.session.query(Message, rank.label('rank'))
+             .options(with_message_authors)
+             .filter(document.op('@@')(query_vector)))
+
+    if author:
+        query = (query
+                 .join(User, User.id == Message.user_id)
+                 .filter(User.username == author))
+    if since:
+        query = query.filter(Message.timestamp >= since)
+    if until:
+        query = query.filter(Message.timestamp < until)
+
+    if cursor:
+        query = query.filter(
+            tuple_(rank, Message.id) < tuple_(*_decode_message_cursor(cursor)))
+
+    results = (query
+               .order_by(rank.desc(), Message.id.desc())
+               .limit(per_page + 1)
+               .all())
+
+    if len(results) > per_page:
+        last = results[per_page - 1]
+        return Page(results[:per_page], f"{last.rank!r},{last.Message.id}")
+
+    return Page(results, None)
@@ -1,19 +1,189 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Each CSV is streamed into Postgres with COPY FROM STDIN, so memory use
+stays flat however big the files are. Indexes and constraints are
+dropped while the tables load and rebuilt afterwards, which is much
+faster than maintaining them row by row, and the id sequences are moved
+past the loaded ids.
 
-db.drop_all()
-db.create_all()
+    python seed.py                   # generator/*.csv
+    python seed.py --data-dir /big   # e.g. output of generator/create_csvs.py
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
+import os
+import sys
+import time
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from sqlalchemy import text
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from app import app, db
+from timelines import rebuild_timelines
+from user_stats import repair_user_stats
 
-db.session.commit()
+# Tables loaded from <data dir>/<table>.csv, in dependency order. A
+# missing CSV is skipped.
+TABLES = ['users', 'messages', 'follows', 'likes']
+
+# Bytes handed to COPY per read.
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds between progress lines.
+PROGRESS_INTERVAL = 5
+
+# Memory Postgres may use for each index rebuild.
+MAINTENANCE_WORK_MEM = os.environ.get('SEED_MAINTENANCE_WORK_MEM', '1GB')
+
+
+def report(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+class ProgressReader:
+    """Wraps a CSV file for COPY, reporting rows read and rows per second.
+
+    Rows are counted by newlines, which is exact for CSVs without quoted
+    line breaks (the generator never writes any).
+    """
+
+    def __init__(self, file, table, total_bytes):
+        self.file = file
+        self.table = table
+        self.total_bytes = total_bytes
+        self.bytes = 0
+        self.rows = 0
+        self.started = self.reported = time.monotonic()
+
+    def read(self, size=CHUNK_SIZE):
+        chunk = self.file.read(size)
+        self.bytes += len(chunk)
+        self.rows += chunk.count(b'\n')
+
+        now = time.monotonic()
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            percent = 100 * self.bytes / self.total_bytes if self.total_bytes else 100
+            report(f"  {self.table}: {self.rows:,} rows ({percent:.0f}%), "
+                   f"{self.rows / (now - self.started):,.0f} rows/s")
+
+        return chunk
+
+
+def deferred_ddl(conn, tables):
+    """Statements that drop, and later recreate, the tables' indexes and constraints.
+
+    Returns (drops, creates). Foreign keys are dropped first and
+    recreated last, since they depend on the keys they reference.
+    """
+
+    constraints = conn.execute(text("""
+        SELECT conrelid::regclass::text AS table_name, conname, contype,
+               pg_get_constraintdef(oid) AS definition
+        FROM pg_constraint
+        WHERE conrelid = ANY(CAST(:tables AS regclass[]))
+          AND contype IN ('p', 'u', 'f')
+    """), {'tables': tables}).all()
+
+    indexes = conn.execute(text("""
+        SELECT indexname, indexdef
+        FROM pg_indexes
+        WHERE schemaname = current_schema()
+          AND tablename = ANY(:tables)
+          AND indexname NOT IN (SELECT conname FROM pg_constraint)
+    """), {'tables': tables}).all()
+
+    foreign = [c for c in constraints if c.contype == 'f']
+    keys = [c for c in constraints if c.contype != 'f']
+
+    def drop_constraint(c):
+        return f'ALTER TABLE {c.table_name} DROP CONSTRAINT "{c.conname}"'
+
+    def add_constraint(c):
+        return f'ALTER TABLE {c.table_name} ADD CONSTRAINT "{c.conname}" {c.definition}'
+
+    drops = ([drop_constraint(c) for c in foreign]
+             + [drop_constraint(c) for c in keys]
+             + [f'DROP INDEX "{i.indexname}"' for i in indexes])
+    creates = ([i.indexdef for i in indexes]
+               + [add_constraint(c) for c in keys]
+               + [add_constraint(c) for c in foreign])
+
+    return drops, creates
+
+
+def copy_csv(conn, table, path):
+    """Stream the CSV at `path` into `table`; return the rows loaded."""
+
+    with open(path, 'rb') as file:
+        columns = file.readline().decode('utf-8').strip()
+        reader = ProgressReader(file, table, os.path.getsize(path))
+
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)",
+            reader, size=CHUNK_SIZE)
+        return cursor.rowcount
+
+
+def reset_sequences(conn, tables):
+    """Move each table's id sequence past the ids loaded into it."""
+
+    for table in tables:
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"),
+                                {'table': table}).scalar()
+        if sequence:
+            conn.execute(text(
+                f"SELECT setval(:sequence, COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) "
+                f"FROM {table}"), {'sequence': sequence})
+
+
+def seed(data_dir):
+    """Recreate the schema and load every CSV found in `data_dir`."""
+
+    db.drop_all()
+    db.create_all()
+
+    all_tables = [table.name for table in db.metadata.sorted_tables]
+    loads = [(table, os.path.join(data_dir, f'{table}.csv')) for table in TABLES]
+    loads = [(table, path) for table, path in loads if os.path.exists(path)]
+
+    with db.engine.begin() as conn:
+        conn.execute(text("SET LOCAL synchronous_commit = off"))
+        conn.execute(text(f"SET LOCAL maintenance_work_mem = '{MAINTENANCE_WORK_MEM}'"))
+
+        drops, creates = deferred_ddl(conn, all_tables)
+        for statement in drops:
+            conn.exec_driver_sql(statement)
+
+        for table, path in loads:
+            started = time.monotonic()
+            rows = copy_csv(conn, table, path)
+            elapsed = time.monotonic() - started
+            report(f"{table}: {rows:,} rows in {elapsed:.1f}s "
+                   f"({rows / max(elapsed, 1e-9):,.0f} rows/s)")
+
+        started = time.monotonic()
+        report(f"rebuilding {len(creates)} indexes and constraints")
+        for statement in creates:
+            conn.exec_driver_sql(statement)
+        report(f"rebuilt in {time.monotonic() - started:.1f}s")
+
+        reset_sequences(conn, [table for table, _ in loads])
+
+        for table, _ in loads:
+            conn.execute(text(f"ANALYZE {table}"))
+
+    started = time.monotonic()
+    with app.app_context():
+        repair_user_stats()
+        rebuild_timelines()
+        db.session.commit()
+    report(f"stats and timelines rebuilt in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator')
+    args = parser.parse_args()
+
+    seed(args.data_dir)
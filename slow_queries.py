@@ -0,0 +1,216 @@
+"""Slow query log.
+
+Any statement that takes SLOW_QUERY_SECONDS or longer is logged and
+recorded with its SQL, its parameters (redacted), the route or thread
+that ran it and, a moment later, its query plan. The last
+SLOW_QUERY_LOG_SIZE records are kept per worker and shown at
+/admin/slow-queries to the users in ADMIN_USER_IDS.
+
+Plans are taken by a background thread, never on the request: it re-runs
+the statement, on the database that ran it (a replica, perhaps), under
+`EXPLAIN (ANALYZE, BUFFERS)` in a transaction that it rolls back, with a
+statement timeout. Anything but a plain SELECT gets a plain `EXPLAIN`,
+since ANALYZE would carry out its writes. Plans are Postgres-only, and
+SLOW_QUERY_EXPLAIN=0 turns them off.
+"""
+
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from sql_stats import failed_cursor
+
+DEFAULT_THRESHOLD = 0.5
+
+DEFAULT_LOG_SIZE = 100
+
+# Plans waiting to be taken; slow queries beyond this go without.
+EXPLAIN_QUEUE_SIZE = 20
+
+EXPLAIN_TIMEOUT_MS = 10_000
+
+# Parameters whose names match are never shown; other strings are cut short.
+SENSITIVE_PARAMETER = re.compile(r'password|email|token|secret', re.IGNORECASE)
+MAX_PARAMETER_LENGTH = 32
+
+logger = logging.getLogger(__name__)
+
+# The slow query log, when SLOW_QUERY_SECONDS is set.
+log = None
+
+_local = threading.local()
+
+
+def configure_slow_queries(app):
+    """Record slow statements if SLOW_QUERY_SECONDS is set."""
+
+    global log
+
+    threshold = app.config.get('SLOW_QUERY_SECONDS', DEFAULT_THRESHOLD)
+    if not threshold:
+        log = None
+        return
+
+    log = SlowQueryLog(threshold,
+                       size=app.config.get('SLOW_QUERY_LOG_SIZE', DEFAULT_LOG_SIZE),
+                       explain=app.config.get('SLOW_QUERY_EXPLAIN', True))
+
+
+def records():
+    """This worker's recorded slow queries, newest first."""
+
+    if log is None:
+        return []
+    return log.records()
+
+
+def redact(parameters, names=None):
+    """A copy of one set of bound parameters that's safe to display.
+
+    Positional parameters are matched up with `names`, where known.
+    """
+
+    if names and isinstance(parameters, (list, tuple)) and len(names) == len(parameters):
+        parameters = dict(zip(names, parameters))
+    if isinstance(parameters, dict):
+        return {name: '[redacted]' if SENSITIVE_PARAMETER.search(name) else _redact_value(value)
+                for name, value in parameters.items()}
+    return [_redact_value(value) for value in parameters or ()]
+
+
+def _redact_value(value):
+    if isinstance(value, str) and len(value) > MAX_PARAMETER_LENGTH:
+        return value[:MAX_PARAMETER_LENGTH] + '…'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f'<{len(value)} bytes>'
+    return value
+
+
+class SlowQuery:
+    """One slow statement; `plan` is filled in once it's been explained."""
+
+    def __init__(self, engine, statement, parameters, rows, route, seconds):
+        self.engine = engine
+        self.statement = statement
+        self.parameters = parameters
+        self.rows = rows
+        self.route = route
+        self.seconds = seconds
+        self.at = datetime.utcnow()
+        self.plan = None
+        self.plan_error = None
+
+
+class SlowQueryLog:
+    """A ring buffer of slow queries, and the thread that explains them."""
+
+    def __init__(self, threshold, size=DEFAULT_LOG_SIZE, explain=True):
+        self.threshold = threshold
+        self.explain = explain
+        self._records = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(EXPLAIN_QUEUE_SIZE)
+        self._thread_pid = None
+
+    def records(self):
+        with self._lock:
+            return list(reversed(self._records))
+
+    def record(self, conn, context, statement, parameters, executemany, seconds):
+        """Add a statement that took `seconds`, and queue it to be explained."""
+
+        first = parameters[0] if executemany and parameters else parameters
+        compiled = getattr(context, 'compiled', None)
+        names = getattr(compiled, 'positiontup', None)
+        if has_request_context():
+            route = request.endpoint or 'unmatched'
+        else:
+            route = threading.current_thread().name
+        slow = SlowQuery(conn.engine, statement, redact(first, names),
+                         len(parameters) if executemany else 1, route, seconds)
+
+        with self._lock:
+            self._records.append(slow)
+        logger.warning('slow query (%.0f ms) in %s: %s',
+                       seconds * 1000, route, ' '.join(statement.split())[:200])
+
+        if not self.explain:
+            return
+        if conn.dialect.name != 'postgresql':
+            slow.plan_error = 'Plans are only taken on Postgres.'
+            return
+
+        self._start_explainer()
+        try:
+            self._queue.put_nowait((slow, statement, first))
+        except queue.Full:
+            slow.plan_error = 'Too many slow queries waiting to be explained.'
+
+    def _start_explainer(self):
+        """Start this process's explainer thread, if it isn't running."""
+
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='slow-query-explainer', daemon=True).start()
+
+    def _run(self):
+        _local.explaining = True
+        while True:
+            slow, statement, parameters = self._queue.get()
+            try:
+                slow.plan = self._explain(slow.engine, statement, parameters)
+            except Exception as exc:
+                slow.plan_error = f'{type(exc).__name__}: {exc}'
+
+    def _explain(self, engine, statement, parameters):
+        analyze = statement.lstrip().upper().startswith('SELECT')
+        explain = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+
+        with engine.connect() as conn:
+            transaction = conn.begin()
+            try:
+                conn.exec_driver_sql(f'SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS}')
+                if parameters:
+                    rows = conn.exec_driver_sql(explain + statement, parameters).all()
+                else:
+                    rows = conn.exec_driver_sql(explain + statement).all()
+            finally:
+                transaction.rollback()
+
+        return '\n'.join(row[0] for row in rows)
+
+
+# Start times are keyed by cursor, as in sql_stats.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if log is not None:
+        conn.info.setdefault('slow_query_started', {})[id(cursor)] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('slow_query_started', {}).pop(id(cursor), None)
+    if log is None or started is None:
+        return
+
+    seconds = time.perf_counter() - started
+    if seconds >= log.threshold and not getattr(_local, 'explaining', False):
+        log.record(conn, context, statement, parameters, executemany, seconds)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_execute(context):
+    cursor = failed_cursor(context)
+    if context.connection is not None and cursor is not None:
+        context.connection.info.get('slow_query_started', {}).pop(id(cursor), None)
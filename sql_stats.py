@@ -0,0 +1,232 @@
+"""Per-request SQL statistics.
+
+Engine events count every statement a request runs, how long the
+database spent on them, and how often each statement *shape* (its text
+with literals, placeholders and IN lists collapsed) came up. A shape
+run over and over in one request is usually an N+1: a query in a loop
+that should have been a join or an IN.
+
+- Every request adds to per-route totals, available from `route_stats()`.
+- With SQL_STATS_HEADER, responses carry `X-SQL-Statements` and a
+  `Server-Timing` entry for the database time.
+- With SQL_STATS_LOG, each request logs one JSON line to `app.logger`.
+- A request that runs any shape SQL_REPEAT_WARNING or more times logs a
+  warning naming it, whatever the other settings.
+
+Tests can hold a block of requests to a budget with `query_budget`.
+"""
+
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_REPEAT_WARNING = 10
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+_routes_lock = threading.Lock()
+_routes = {}
+
+_PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|\?|\$\d+|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+@lru_cache(maxsize=2048)
+def statement_shape(statement):
+    """`statement` with literals and parameters as ?, and lists of them as one."""
+
+    return _LISTS.sub('?, ...', _PLACEHOLDERS.sub('?', ' '.join(statement.split())))
+
+
+class QueryStats:
+    """Statements run, database time and statement shapes, for one block."""
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.shapes = Counter()
+
+    def add(self, statement, seconds):
+        self.statements += 1
+        self.db_seconds += seconds
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, min_count=2):
+        """{shape: count} for shapes run at least `min_count` times."""
+
+        return {shape: count for shape, count in self.shapes.most_common()
+                if count >= min_count}
+
+    def __repr__(self):
+        return (f"<QueryStats {self.statements} statements, "
+                f"{self.db_seconds * 1000:.1f}ms>")
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A block ran more statements, or repeated one more often, than allowed."""
+
+
+def _collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+@contextmanager
+def record_queries():
+    """Collect QueryStats for the statements this thread runs inside the block."""
+
+    stats = QueryStats()
+    collectors = _collectors()
+    collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        collectors.remove(stats)
+
+
+@contextmanager
+def query_budget(max_statements, max_repeats=None):
+    """Fail if the block runs more than `max_statements` statements.
+
+    With `max_repeats`, also fail if any one shape runs more often than
+    that. Requests made through the test client count, since they run
+    on the calling thread.
+    """
+
+    with record_queries() as stats:
+        yield stats
+
+    problems = []
+    if stats.statements > max_statements:
+        problems.append(f"{stats.statements} statements, budget {max_statements}")
+    if max_repeats is not None:
+        for shape, count in stats.repeated(max_repeats + 1).items():
+            problems.append(f"{count}x (max {max_repeats}): {shape}")
+    if problems:
+        raise QueryBudgetExceeded('\n'.join(problems))
+
+
+# Start times are keyed by cursor, and dropped when a statement fails,
+# since after_cursor_execute never runs for it.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', {})[id(cursor)] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop(id(cursor), None)
+    collectors = getattr(_local, 'collectors', None)
+    if collectors and started is not None:
+        seconds = time.perf_counter() - started
+        for stats in collectors:
+            stats.add(statement, seconds)
+
+
+def failed_cursor(context):
+    """The cursor of the statement an Engine `handle_error` event is for, if any."""
+
+    return context.cursor or getattr(context.execution_context, 'cursor', None)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_execute(context):
+    cursor = failed_cursor(context)
+    if context.connection is not None and cursor is not None:
+        context.connection.info.get('query_started', {}).pop(id(cursor), None)
+
+
+def route_stats():
+    """Per-endpoint totals of this worker's requests."""
+
+    with _routes_lock:
+        return {endpoint: dict(totals) for endpoint, totals in _routes.items()}
+
+
+def reset_route_stats():
+    """Forget the per-route totals."""
+
+    with _routes_lock:
+        _routes.clear()
+
+
+def _record_route(endpoint, stats, repeated):
+    with _routes_lock:
+        totals = _routes.setdefault(endpoint, {
+            'requests': 0,
+            'statements': 0,
+            'max_statements': 0,
+            'db_seconds': 0.0,
+            'max_db_seconds': 0.0,
+            'requests_with_repeats': 0,
+        })
+        totals['requests'] += 1
+        totals['statements'] += stats.statements
+        totals['max_statements'] = max(totals['max_statements'], stats.statements)
+        totals['db_seconds'] += stats.db_seconds
+        totals['max_db_seconds'] = max(totals['max_db_seconds'], stats.db_seconds)
+        totals['requests_with_repeats'] += bool(repeated)
+
+
+def configure_sql_stats(app):
+    """Collect SQL statistics for every request to `app`."""
+
+    # The JSON lines are logged at INFO, which the root logger's default
+    # WARNING level would drop.
+    if app.logger.level == logging.NOTSET:
+        app.logger.setLevel(logging.INFO)
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = QueryStats()
+        _collectors().append(g.sql_stats)
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+
+        endpoint = request.endpoint or '<unmatched>'
+        repeated = stats.repeated(app.config.get('SQL_REPEAT_WARNING',
+                                                 DEFAULT_REPEAT_WARNING))
+        _record_route(endpoint, stats, repeated)
+
+        if app.config.get('SQL_STATS_HEADER'):
+            response.headers['X-SQL-Statements'] = str(stats.statements)
+            response.headers.add('Server-Timing', f'db;dur={stats.db_seconds * 1000:.3f}')
+
+        if app.config.get('SQL_STATS_LOG'):
+            app.logger.info(json.dumps({
+                'endpoint': endpoint,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'statements': stats.statements,
+                'db_ms': round(stats.db_seconds * 1000, 3),
+                'repeated': stats.repeated(),
+            }))
+
+        for shape, count in repeated.items():
+            logger.warning('%s ran %d times in one request (possible N+1): %s',
+                           endpoint, count, shape)
+
+        return response
+
+    @app.teardown_request
+    def stop_sql_stats(exc):
+        stats = g.pop('sql_stats', None)
+        if stats is not None and stats in _collectors():
+            _collectors().remove(stats)
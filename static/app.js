@@ -1,22 +1,77 @@
 "use strict"
 
-/** handles favoriteclick event by changing favorite icon and
- *  adding/removing favorite from db
+/** shows a star as liked or not, with the message's like count */
+function showStar(star, liked, likes) {
+  if (liked) {
+    star.className = "fa fa-star";
+    $(star).attr("style", "color:rgb(244, 244, 51)");
+  } else {
+    star.className = "far fa-star";
+    $(star).attr("style", "color:black");
+  }
+  if (likes !== undefined) $(star).attr("title", `${likes} likes`);
+}
+
+/** handles favoriteclick event by toggling the favorite icon right away,
+ *  then toggling the like on the server and showing the state it returns
  */
  async function favoriteClick(evt) {
   evt.preventDefault();
-  let msgId = $(evt.target).closest('div').data('message-id');
+  let star = evt.target;
+  let msgId = $(star).closest('div').data('message-id');
 
-  // if message is liked
-  if (evt.target.className === "fa fa-star") {
-    evt.target.className = "far fa-star";
-    $(evt.target).attr("style", "color:black");
-  } else {
-    evt.target.className = "fa fa-star"
-    $(evt.target).attr("style", "color:rgb(244, 244, 51)");
-  }
+  showStar(star, star.className !== "fa fa-star");
 
-  axios({url: `/messages/${msgId}/like`, method: "POST"});
+  try {
+    let resp = await axios({url: `/api/messages/${msgId}/like`, method: "POST"});
+    showStar(star, resp.data.liked, resp.data.likes);
+  } catch (err) {
+    // put the star back the way it was
+    showStar(star, star.className !== "fa fa-star");
+  }
 }
 
 $("#messages").on("click", ".fa-star", favoriteClick);
+
+/** handles a "load more" link by fetching the next page as JSON,
+ *  appending its rows to the list and pointing the link at the page after;
+ *  if the fetch fails, the link stays put so it can be clicked again
+ */
+async function loadMore(evt) {
+  evt.preventDefault();
+  let $link = $(evt.target);
+
+  if ($link.data("loading")) return;
+  $link.data("loading", true);
+
+  try {
+    let resp = await axios({
+      url: $link.attr("href"),
+      headers: {Accept: "application/json"},
+    });
+
+    $($link.data("target")).append(resp.data.html);
+
+    if (resp.data.next) {
+      $link.attr("href", resp.data.next).text("Load more");
+    } else {
+      $link.remove();
+    }
+  } catch (err) {
+    $link.text("Couldn't load more. Try again");
+  } finally {
+    $link.data("loading", false);
+  }
+}
+
+$("body").on("click", ".load-more", loadMore);
+
+// load the next page automatically when the "load more" link scrolls into view
+if ("IntersectionObserver" in window) {
+  let observer = new IntersectionObserver(entries => {
+    for (let entry of entries) {
+      if (entry.isIntersecting) $(entry.target).trigger("click");
+    }
+  });
+  $(".load-more").each((i, link) => observer.observe(link));
+}
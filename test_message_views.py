@@ -5,9 +5,25 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import json
+import logging
+import multiprocessing
 import os
+import tempfile
+import threading
+import time
+from datetime import datetime
 from unittest import TestCase
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, TimelineEntry, Like
+from timelines import (DEFAULT_FANOUT_THRESHOLD, DEFAULT_PUSH_THRESHOLD, push_message,
+                       resume_pushing, trim_timelines)
+from user_stats import profile_changed
+from fragments import FragmentCache, message_rows
+from pagination import MESSAGES_PER_PAGE
+import metrics
+import profiling
+from sql_stats import (record_queries, query_budget, route_stats, reset_route_stats,
+                       statement_shape, QueryBudgetExceeded, DEFAULT_REPEAT_WARNING)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -26,10 +42,15 @@ from app import app, CURR_USER_KEY
 
 db.create_all()
 
+METRICS_AUTHORIZATION = {"Authorization": "Bearer metrics-token"}
+
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Statements the homepage may run for a logged-in user.
+HOMEPAGE_QUERY_BUDGET = 8
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -41,6 +62,7 @@ class MessageViewTestCase(TestCase):
         Message.query.delete()
 
         self.client = app.test_client()
+        message_rows.clear()
 
         self.user0 = User.signup(username="user",
                                     email="test@test.com",
@@ -129,3 +151,746 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("user", str(resp.data))
             self.assertIn("test message", str(resp.data))
+
+    def test_message_page_conditional_get(self):
+        """Is an anonymous message page revalidated with its ETag?"""
+
+        resp = self.client.get(f"/messages/{self.msg0_id}")
+        etag = resp.headers["ETag"]
+        self.assertTrue(resp.cache_control.public)
+        self.assertTrue(resp.cache_control.no_cache)
+
+        resp = self.client.get(f"/messages/{self.msg0_id}",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+
+        user = User.query.get(self.user0_id)
+        user.username = "renamed"
+        profile_changed(user.id)
+        db.session.commit()
+
+        resp = self.client.get(f"/messages/{self.msg0_id}",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("renamed", str(resp.data))
+
+    def test_anon_homepage_last_modified(self):
+        """Does the anonymous homepage answer If-Modified-Since?"""
+
+        resp = self.client.get("/")
+        last_modified = resp.headers["Last-Modified"]
+
+        resp = self.client.get("/", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_logged_in_pages_private(self):
+        """Are a logged-in user's pages private and never validated?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            resp = c.get(f"/messages/{self.msg0_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.cache_control.private)
+            self.assertTrue(resp.cache_control.no_cache)
+            self.assertNotIn("ETag", resp.headers)
+
+    def test_flashed_page_not_shared(self):
+        """Is a page showing a flashed message rendered, not served as 304?"""
+
+        etag = self.client.get("/").headers["ETag"]
+
+        with self.client as c:
+            c.post(f"/messages/{self.msg0_id}/delete")
+            resp = c.get("/", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Access unauthorized", str(resp.data))
+            self.assertTrue(resp.cache_control.private)
+
+    def test_versioned_static_files_cached(self):
+        """Are static files linked with a version cached for a year?"""
+
+        resp = self.client.get("/")
+        self.assertIn("/static/app.js?v=", str(resp.data))
+
+        version = str(resp.data).split('src="/static/app.js?v=')[1].split('"')[0]
+        resp = self.client.get(f"/static/app.js?v={version}")
+        self.assertEqual(resp.cache_control.max_age, 365 * 24 * 60 * 60)
+        self.assertTrue(resp.cache_control.immutable)
+        resp.close()
+
+        resp = self.client.get("/static/app.js")
+        self.assertEqual(resp.cache_control.max_age, 60 * 60)
+        resp.close()
+
+    def test_message_rows_cached(self):
+        """Are message rows rendered once and reused across pages?"""
+
+        first = self.client.get(f"/users/{self.user0_id}").data
+        self.assertEqual(message_rows.stats()["misses"], 1)
+
+        second = self.client.get(f"/users/{self.user0_id}").data
+        self.assertEqual(message_rows.stats()["hits"], 1)
+        self.assertEqual(first, second)
+        self.assertIn("test message", str(second))
+
+    def test_message_row_star_per_viewer(self):
+        """Does each viewer see their own star on a shared cached row?"""
+
+        liker = User.signup(username="liker", email="liker@test.com",
+                            password="password", image_url=None)
+        db.session.add(liker)
+        db.session.commit()
+        liker_id = liker.id
+        db.session.add(Like(user_id=liker_id, message_id=self.msg0_id))
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.user0_id}")
+        self.assertIn("far fa-star", str(resp.data))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_id
+            resp = c.get(f"/users/{self.user0_id}")
+            self.assertIn('"fa fa-star"', str(resp.data))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+            resp = c.get(f"/users/{self.user0_id}")
+            self.assertNotIn("fa-star", str(resp.data))
+
+        self.assertEqual(message_rows.stats()["misses"], 1)
+
+    def test_message_row_follows_author_rename(self):
+        """Does a renamed author get freshly rendered rows?"""
+
+        self.client.get(f"/users/{self.user0_id}")
+
+        user = User.query.get(self.user0_id)
+        user.username = "renamed"
+        profile_changed(user.id)
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.user0_id}")
+        self.assertIn("@renamed", str(resp.data))
+
+    def test_fragment_cache_memory_cap(self):
+        """Does the fragment cache evict the least recently used to fit?"""
+
+        cache = FragmentCache(max_bytes=10)
+        cache.set("a", "aaaa")
+        cache.set("b", ("bb", "bb"))
+        cache.get("a")
+        cache.set("c", "cccc")
+
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "aaaa")
+        stats = cache.stats()
+        self.assertEqual((stats["bytes"], stats["evictions"]), (8, 1))
+        self.assertEqual(stats["hit_rate"], 2 / 3)
+
+    def test_added_message_on_followers_timeline(self):
+        """Is a new message pushed to its author's followers' homepages?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="password",
+                               image_url=None)
+        follower.following.append(self.user0)
+        db.session.commit()
+        follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post("/messages/new", data={"text": "fanned out"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("fanned out", str(resp.data))
+
+    def test_deleted_message_leaves_timeline(self):
+        """Is a deleted message removed from its author's homepage?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post("/messages/new", data={"text": "short lived"})
+            msg = Message.query.filter_by(text="short lived").one()
+
+            c.post(f"/messages/{msg.id}/delete")
+            resp = c.get("/")
+
+            self.assertNotIn("short lived", str(resp.data))
+
+    def test_timelines_trimmed(self):
+        """Does trimming keep only each timeline's newest entries?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post("/messages/new", data={"text": "older"})
+            c.post("/messages/new", data={"text": "newer"})
+
+        trim_timelines(limit=1)
+        db.session.commit()
+
+        entries = TimelineEntry.query.filter_by(user_id=self.user0_id).all()
+        self.assertEqual([Message.query.get(entry.message_id).text for entry in entries],
+                         ["newer"])
+
+    def test_push_trims_timelines(self):
+        """Does pushing a message trim its readers' timelines?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="password",
+                               image_url=None)
+        db.session.commit()
+        follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            c.post(f"/users/follow/{self.user0_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post("/messages/new", data={"text": "pushed out"})
+
+        msg = Message(text="pushed in", user_id=self.user0_id)
+        db.session.add(msg)
+        db.session.flush()
+        with app.app_context():
+            push_message(msg, limit=1)
+            db.session.commit()
+
+        for user_id in (self.user0_id, follower_id):
+            entries = TimelineEntry.query.filter_by(user_id=user_id).all()
+            self.assertEqual([Message.query.get(entry.message_id).text for entry in entries],
+                             ["pushed in"])
+
+    def test_pulled_author_merged_into_timeline(self):
+        """Are messages by authors over the fan-out threshold merged on read?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="password",
+                               image_url=None)
+        db.session.commit()
+        follower_id = follower.id
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 0
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+
+                c.post(f"/users/follow/{self.user0_id}")
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user0_id
+
+                c.post("/messages/new", data={"text": "pulled on read"})
+
+                msg = Message.query.filter_by(text="pulled on read").one()
+                self.assertEqual(
+                    TimelineEntry.query
+                    .filter_by(user_id=follower_id, message_id=msg.id)
+                    .count(), 0)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = follower_id
+
+                resp = c.get("/")
+
+                self.assertIn("pulled on read", str(resp.data))
+        finally:
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = DEFAULT_FANOUT_THRESHOLD
+
+    def test_author_below_threshold_backfilled(self):
+        """Do followers who followed a pulled author get their messages once it's pushed again?"""
+
+        followers = [User.signup(username=f"follower{i}",
+                                 email=f"follower{i}@test.com",
+                                 password="password",
+                                 image_url=None)
+                     for i in range(3)]
+        db.session.commit()
+        first, second, late = [follower.id for follower in followers]
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        app.config['TIMELINE_PUSH_THRESHOLD'] = 0
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user0_id
+                c.post("/messages/new", data={"text": "pulled then pushed"})
+
+                # two followers make the author a pulled one, so the
+                # third isn't backfilled
+                for follower_id in (first, second, late):
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = follower_id
+                    c.post(f"/users/follow/{self.user0_id}")
+
+                for follower_id in (first, second):
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = follower_id
+                    c.post(f"/users/stop-following/{self.user0_id}")
+
+            msg = Message.query.filter_by(text="pulled then pushed").one()
+            late_entries = (TimelineEntry.query
+                            .filter_by(user_id=late, message_id=msg.id))
+
+            # back at the fan-out threshold, but not yet at the push one
+            with app.app_context():
+                resume_pushing(batch_size=1)
+            self.assertEqual(late_entries.count(), 0)
+            self.assertTrue(User.query.get(self.user0_id).timeline_pulled)
+
+            app.config['TIMELINE_PUSH_THRESHOLD'] = 1
+            with app.app_context():
+                resume_pushing(batch_size=1)
+            self.assertEqual(late_entries.count(), 1)
+            self.assertFalse(User.query.get(self.user0_id).timeline_pulled)
+        finally:
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = DEFAULT_FANOUT_THRESHOLD
+            app.config['TIMELINE_PUSH_THRESHOLD'] = DEFAULT_PUSH_THRESHOLD
+
+    def test_user_page_paginates_messages(self):
+        """Does a profile page show one page of messages plus a cursor link?"""
+
+        for i in range(MESSAGES_PER_PAGE):
+            db.session.add(Message(text=f"paged message {i}",
+                                   user_id=self.user0_id,
+                                   timestamp=datetime(2020, 1, 1, 0, i)))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.user0_id}")
+            html = str(resp.data)
+
+            self.assertIn(f"paged message {MESSAGES_PER_PAGE - 1}<", html)
+            self.assertNotIn("paged message 0<", html)
+            self.assertIn("Load more", html)
+
+            cursor = html.split("cursor=")[1].split('"')[0]
+            data = c.get(f"/users/{self.user0_id}?format=json&cursor={cursor}").get_json()
+
+            self.assertIn("paged message 0<", data["html"])
+            self.assertIsNone(data["next"])
+
+    def test_message_counts(self):
+        """Do adding and deleting messages keep messages_count current?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post("/messages/new", data={"text": "counted"})
+
+            self.assertEqual(User.query.get(self.user0_id).messages_count, 1)
+
+            msg = Message.query.filter_by(text="counted").one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(User.query.get(self.user0_id).messages_count, 0)
+
+    def test_timeline_likes_not_n_plus_one(self):
+        """Does rendering a timeline's stars take a fixed number of queries?"""
+
+        liker = User.signup(username="liker",
+                            email="liker@test.com",
+                            password="password",
+                            image_url=None)
+        db.session.commit()
+        liker_id = liker.id
+
+        def login(c, user_id):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+        def post_and_like(c, num_messages):
+            login(c, self.user0_id)
+            for i in range(num_messages):
+                c.post("/messages/new", data={"text": f"star {i}"})
+
+            login(c, liker_id)
+            star_ids = [msg.id for msg in
+                        Message.query.filter(Message.text.like("star %")).all()]
+            for msg_id in star_ids[::2]:
+                if not Like.query.get((liker_id, msg_id)):
+                    c.post(f"/messages/{msg_id}/like")
+
+        def timeline_queries(c):
+            with record_queries() as stats:
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(str(resp.data).count('class="fa fa-star"'),
+                             Like.query.filter_by(user_id=liker_id).count())
+            return stats.statements
+
+        with self.client as c:
+            login(c, liker_id)
+            c.post(f"/users/follow/{self.user0_id}")
+
+            post_and_like(c, 2)
+            few = timeline_queries(c)
+
+            post_and_like(c, 18)
+            many = timeline_queries(c)
+
+        self.assertEqual(few, many)
+
+    def test_timeline_authors_loaded_in_batch(self):
+        """Do timelines load their authors in a fixed number of queries?"""
+
+        reader = User.signup(username="reader",
+                             email="reader@test.com",
+                             password="password",
+                             image_url=None)
+        db.session.commit()
+        reader_id = reader.id
+
+        def add_authors(c, start, stop):
+            for i in range(start, stop):
+                author = User(username=f"author{i}",
+                              email=f"author{i}@test.com",
+                              password="HASHED_PASSWORD")
+                db.session.add(author)
+                db.session.flush()
+                msg = Message(text=f"by author{i}", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Like(user_id=reader_id, message_id=msg.id))
+                db.session.commit()
+
+                c.post(f"/users/follow/{author.id}")
+
+        def page_queries(c, url):
+            with record_queries() as stats:
+                resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            return stats.statements
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = reader_id
+
+            add_authors(c, 0, 2)
+            few = [page_queries(c, "/"), page_queries(c, f"/users/{reader_id}/likes")]
+
+            add_authors(c, 2, 10)
+            many = [page_queries(c, "/"), page_queries(c, f"/users/{reader_id}/likes")]
+
+            self.assertIn("@author9", str(c.get("/").data))
+
+        self.assertEqual(few, many)
+
+    def test_homepage_query_budget(self):
+        """Does the homepage stay within its query budget, with no repeats?"""
+
+        reader = User.signup(username="reader",
+                             email="reader@test.com",
+                             password="password",
+                             image_url=None)
+        db.session.commit()
+        reader_id = reader.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = reader_id
+
+            c.post(f"/users/follow/{self.user0_id}")
+            c.post(f"/messages/{self.msg0_id}/like")
+
+            with query_budget(HOMEPAGE_QUERY_BUDGET, max_repeats=1):
+                resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+
+            with self.assertRaises(QueryBudgetExceeded):
+                with query_budget(1):
+                    c.get("/")
+
+    def test_sql_stats_reported(self):
+        """Are statement counts sent in headers and added to route totals?"""
+
+        reset_route_stats()
+        app.config['SQL_STATS_HEADER'] = True
+        try:
+            resp = self.client.get(f"/messages/{self.msg0_id}")
+        finally:
+            app.config['SQL_STATS_HEADER'] = False
+
+        statements = int(resp.headers["X-SQL-Statements"])
+        self.assertGreater(statements, 0)
+        self.assertTrue(resp.headers["Server-Timing"].startswith("db;dur="))
+
+        totals = route_stats()["messages_show"]
+        self.assertEqual(totals["requests"], 1)
+        self.assertEqual(totals["statements"], statements)
+
+        self.assertNotIn("X-SQL-Statements", self.client.get("/").headers)
+
+    def test_sql_stats_logged(self):
+        """Does SQL_STATS_LOG log a JSON line for each request?"""
+
+        self.assertTrue(app.logger.isEnabledFor(logging.INFO))
+
+        app.config['SQL_STATS_LOG'] = True
+        try:
+            with self.assertLogs(app.logger, "INFO") as logs:
+                self.client.get(f"/messages/{self.msg0_id}")
+        finally:
+            app.config['SQL_STATS_LOG'] = False
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line["endpoint"], "messages_show")
+        self.assertEqual(line["status"], 200)
+        self.assertGreater(line["statements"], 0)
+
+    def test_metrics(self):
+        """Does /metrics report latency, responses and caches by endpoint?"""
+
+        self.client.get(f"/messages/{self.msg0_id}")
+        message_rows.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+            # stopping following someone you don't follow fails
+            self.assertEqual(c.post("/users/stop-following/0").status_code, 500)
+
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+        app.config['METRICS_TOKEN'] = "metrics-token"
+        try:
+            self.assertEqual(self.client.get(
+                "/metrics", headers={"Authorization": "Bearer wrong"}).status_code, 404)
+            resp = self.client.get("/metrics", headers=METRICS_AUTHORIZATION)
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain; version=0.0.4"))
+        text = resp.get_data(as_text=True)
+        self.assertIn("# TYPE warbler_request_duration_seconds histogram", text)
+        self.assertIn('warbler_request_duration_seconds_bucket{endpoint="messages_show",le="+Inf"}',
+                      text)
+        self.assertIn('warbler_requests_total{endpoint="messages_show",status="200"}', text)
+        self.assertIn('warbler_requests_total{endpoint="stop_following",status="500"}', text)
+        self.assertIn('warbler_request_template_seconds_total{endpoint="messages_show"}', text)
+
+        # clearing the cache doesn't take its lookups back
+        self.assertNotIn('warbler_cache_misses_total{cache="message_rows"} 0.0', text)
+        self.assertIn('warbler_cache_misses_total{cache="message_rows"}', text)
+
+    def test_metrics_summed_across_processes(self):
+        """Does /metrics add up every worker's values under METRICS_DIR, including exited ones?"""
+
+        histogram = metrics.Histogram("test_seconds", "Test.", ("name",), buckets=(0.1, 1))
+        app.config['METRICS_TOKEN'] = "metrics-token"
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                metrics.use_directory(directory)
+                histogram.observe(("a",), 0.05)
+
+                worker = multiprocessing.get_context("fork").Process(
+                    target=histogram.observe, args=(("a",), 0.5))
+                worker.start()
+                worker.join()
+                worker_file = f"warbler-{worker.pid}-"
+
+                text = self.client.get("/metrics", headers=METRICS_AUTHORIZATION).get_data(
+                    as_text=True)
+                self.assertTrue(any(name.startswith(worker_file)
+                                    for name in os.listdir(directory)))
+
+                # a replacement worker folds the exited one into the totals
+                metrics.use_directory(directory)
+                merged = self.client.get("/metrics", headers=METRICS_AUTHORIZATION).get_data(
+                    as_text=True)
+                self.assertFalse(any(name.startswith(worker_file)
+                                     for name in os.listdir(directory)))
+                self.assertIn(metrics.TOTALS_FILENAME, os.listdir(directory))
+        finally:
+            app.config['METRICS_TOKEN'] = None
+            metrics.use_directory(None)
+            metrics.registry.remove(histogram)
+
+        for scrape in (text, merged):
+            self.assertIn('test_seconds_bucket{name="a",le="0.1"} 1.0', scrape)
+            self.assertIn('test_seconds_bucket{name="a",le="1.0"} 2.0', scrape)
+            self.assertIn('test_seconds_bucket{name="a",le="+Inf"} 2.0', scrape)
+            self.assertIn('test_seconds_sum{name="a"} 0.55', scrape)
+            self.assertIn('test_seconds_count{name="a"} 2.0', scrape)
+
+    def test_profiling(self):
+        """Are sampled and signed-header requests profiled, and others not?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            app.config.update(PROFILE_DIR=directory, PROFILE_INTERVAL=0.0001,
+                              PROFILE_SECRET="profile-secret")
+            try:
+                resp = self.client.get(f"/messages/{self.msg0_id}")
+                self.assertNotIn("X-Profile", resp.headers)
+
+                resp = self.client.get(f"/messages/{self.msg0_id}",
+                                       headers={"X-Profile-Token": "forged"})
+                self.assertNotIn("X-Profile", resp.headers)
+
+                token = profiling.profile_token("profile-secret")
+                resp = self.client.get(f"/messages/{self.msg0_id}",
+                                       headers={"X-Profile-Token": token})
+                signed = resp.headers["X-Profile"]
+
+                app.config['PROFILE_SAMPLE_RATE'] = 1
+                sampled = self.client.get("/").headers["X-Profile"]
+                profiling.wait()
+            finally:
+                app.config.update(PROFILE_SAMPLE_RATE=0, PROFILE_SECRET=None)
+
+            self.assertEqual(sorted(os.listdir(directory)), sorted([signed, sampled]))
+            self.assertTrue(signed.startswith("messages_show-"))
+
+            # a quick request may finish before the first sample
+            with open(os.path.join(directory, signed)) as file:
+                for line in file:
+                    stack, count = line.rsplit(" ", 1)
+                    self.assertTrue(stack.startswith("messages_show;"))
+                    self.assertGreater(int(count), 0)
+
+            path = os.path.join(directory, "busy.collapsed")
+            sampler = profiling.Sampler(threading.get_ident(), path, "busy", 0.0001)
+            sampler.start()
+            deadline = time.monotonic() + 0.1
+            while time.monotonic() < deadline:
+                pass
+            sampler.stop()
+            sampler.join()
+
+            with open(path) as file:
+                stack, count = file.readline().rsplit(" ", 1)
+            self.assertTrue(stack.startswith("busy;"))
+            self.assertIn("test_profiling (test_message_views.py:", stack)
+            self.assertGreater(int(count), 0)
+
+    def test_repeated_statements_logged(self):
+        """Are statement shapes run too often in one request logged?"""
+
+        self.assertEqual(
+            statement_shape("SELECT * FROM users WHERE id IN (%(id_1_1)s, %(id_1_2)s)\n LIMIT 5"),
+            "SELECT * FROM users WHERE id IN (?, ...) LIMIT ?")
+
+        app.config['SQL_REPEAT_WARNING'] = 1
+        try:
+            with self.assertLogs("sql_stats", "WARNING") as logs:
+                self.client.get(f"/messages/{self.msg0_id}")
+        finally:
+            app.config['SQL_REPEAT_WARNING'] = DEFAULT_REPEAT_WARNING
+
+        self.assertIn("messages_show ran 1 times", logs.output[0])
+
+    def test_failed_statement_not_timed(self):
+        """Does a statement that raises leave no start time behind?"""
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.exec_driver_sql("SELECT * FROM no_such_table")
+            self.assertEqual(conn.info["query_started"], {})
+
+            with record_queries() as stats:
+                conn.exec_driver_sql("SELECT 1")
+            self.assertEqual(stats.statements, 1)
+
+    def test_message_search(self):
+        """Does message search find, filter and drop messages as they change?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post("/messages/new", data={"text": "Herons are wading birds"})
+
+            resp = c.get("/messages/search?q=heron")
+            self.assertIn("Herons are wading birds", str(resp.data))
+
+            resp = c.get("/messages/search?q=heron&author=nobody")
+            self.assertNotIn("Herons are wading birds", str(resp.data))
+
+            resp = c.get("/messages/search?q=heron&since=1999-01-01&until=1999-12-31")
+            self.assertNotIn("Herons are wading birds", str(resp.data))
+
+            data = c.get("/api/messages/search?q=heron&author=user").get_json()
+            self.assertEqual([m["text"] for m in data["messages"]],
+                             ["Herons are wading birds"])
+            self.assertEqual(data["messages"][0]["user"]["username"], "user")
+            self.assertIsNone(data["next"])
+
+            c.post(f"/messages/{data['messages'][0]['id']}/delete")
+
+            data = c.get("/api/messages/search?q=heron").get_json()
+            self.assertEqual(data["messages"], [])
+
+    def test_message_search_ranks_and_paginates(self):
+        """Are better matches first, with a cursor to the rest?"""
+
+        for i in range(MESSAGES_PER_PAGE):
+            db.session.add(Message(text=f"egret {i}", user_id=self.user0_id))
+        db.session.add(Message(text="egret egret egret", user_id=self.user0_id))
+        db.session.commit()
+
+        with self.client as c:
+            data = c.get("/api/messages/search?q=egret").get_json()
+
+            self.assertEqual(len(data["messages"]), MESSAGES_PER_PAGE)
+            self.assertEqual(data["messages"][0]["text"], "egret egret egret")
+
+            data = c.get(data["next"]).get_json()
+
+            self.assertEqual(len(data["messages"]), 1)
+            self.assertIsNone(data["next"])
+
+    def test_message_search_pages_through_ties(self):
+        """Does paging through equally ranked matches show each exactly once?"""
+
+        count = MESSAGES_PER_PAGE * 2 + 3
+        for i in range(count):
+            db.session.add(Message(text=f"bittern number {i}", user_id=self.user0_id))
+        db.session.commit()
+
+        with self.client as c:
+            texts = []
+            url = "/api/messages/search?q=bittern"
+            while url:
+                data = c.get(url).get_json()
+                texts.extend(message["text"] for message in data["messages"])
+                url = data["next"]
+
+        self.assertEqual(sorted(texts), sorted(f"bittern number {i}" for i in range(count)))
+
+    def test_message_search_bad_date(self):
+        """Is a malformed date filter rejected?"""
+
+        with self.client as c:
+            resp = c.get("/messages/search?q=heron&since=yesterday")
+
+            self.assertEqual(resp.status_code, 400)
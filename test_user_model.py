@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Like
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,6 +20,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app
+from user_stats import repair_user_stats, profile_changed
+import passwords
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -146,6 +148,23 @@ class UserModelTestCase(TestCase):
         invalid_password = User.authenticate('test2', 'password5')
         self.assertEqual(invalid_password, False)
 
+    def test_user_authentication_rehashes(self):
+        """Does logging in upgrade a hash made with an old work factor"""
+
+        old_rounds = passwords.settings.log_rounds
+
+        try:
+            passwords.settings.log_rounds = 4
+            self.assertTrue(self.user0.password.startswith(f"$2b${old_rounds:02}$"))
+
+            user = User.authenticate('test0', 'password0')
+            db.session.commit()
+
+            self.assertTrue(user.password.startswith("$2b$04$"))
+            self.assertEqual(User.authenticate('test0', 'password0'), user)
+        finally:
+            passwords.settings.log_rounds = old_rounds
+
     #### FOLLOW TESTS
     def test_user_follows(self):
         """Does following/followers work as intended?"""
@@ -188,4 +207,61 @@ class UserModelTestCase(TestCase):
         db.session.commit()
 
         self.assertEqual(self.user0.is_followed_by(self.user1), False)
-        self.assertEqual(self.user1.is_followed_by(self.user0), True)
\ No newline at end of file
+        self.assertEqual(self.user1.is_followed_by(self.user0), True)
+
+    def test_user_following_ids_among(self):
+        """Does {user}.following_ids_among(ids) return only followed ids"""
+
+        user2 = User.signup('test2', 'test2@email.com', 'password2', None)
+        self.user0.following.append(self.user1)
+        db.session.commit()
+
+        self.assertEqual(
+            self.user0.following_ids_among([self.user1.id, user2.id]),
+            {self.user1.id})
+        self.assertEqual(self.user0.following_ids_among([]), set())
+
+    def test_repair_user_stats(self):
+        """Does repair_user_stats recompute counts from the base tables?"""
+
+        self.user0.following.append(self.user1)
+        db.session.add(Message(text="uncounted", user_id=self.user0.id))
+        stranger = User.signup(username='test2', email='test2@email.com',
+                               password='password2', image_url=None)
+        db.session.commit()
+        versions = (self.user0.version, stranger.version)
+
+        repair_user_stats()
+        db.session.commit()
+
+        # only users whose counts changed have their pages invalidated
+        self.assertEqual(self.user0.version, versions[0] + 1)
+        self.assertEqual(stranger.version, versions[1])
+
+        self.assertEqual(self.user0.messages_count, 1)
+        self.assertEqual(self.user0.following_count, 1)
+        self.assertEqual(self.user1.followers_count, 1)
+        self.assertEqual(self.user1.likes_count, 0)
+
+    def test_profile_changed_bumps_versions(self):
+        """Does a profile change bump everyone whose pages show the user?"""
+
+        user2 = User.signup(username='test2', email='test2@email.com',
+                            password='password2', image_url=None)
+        stranger = User.signup(username='test3', email='test3@email.com',
+                               password='password3', image_url=None)
+        msg = Message(text="liked", user_id=self.user0.id)
+        self.user1.following.append(self.user0)
+        db.session.add(msg)
+        db.session.commit()
+        db.session.add(Like(user_id=user2.id, message_id=msg.id))
+        db.session.commit()
+
+        before = {u.id: u.version for u in User.query}
+        profile_changed(self.user0.id)
+        db.session.commit()
+        db.session.expire_all()
+
+        for user in (self.user0, self.user1, user2):
+            self.assertEqual(User.query.get(user.id).version, before[user.id] + 1)
+        self.assertEqual(User.query.get(stranger.id).version, before[stranger.id])
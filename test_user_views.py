@@ -1,16 +1,35 @@
 """Message View tests."""
 
 import os
+import time
 from unittest import TestCase
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Like
+from sqlalchemy.exc import OperationalError
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, login_username_limiter, login_address_limiter
+from pagination import USERS_PER_PAGE
+from passwords import hashing_stats
+from ratelimit import TokenBucketLimiter
+import likes
+import replicas
+import slow_queries
+from sql_stats import record_queries, query_budget
 
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False    
+
+# Statements a profile page may run for a logged-in viewer.
+USERS_SHOW_QUERY_BUDGET = 8
+
+# A second database standing in for a read replica.
+REPLICA_DATABASE_URL = os.environ.get('REPLICA_TEST_DATABASE_URL',
+                                      "postgresql:///warbler_test_replica")
+
+# Nothing listens here, so a replica bound to it always fails its check.
+DOWN_DATABASE_URL = "postgresql://localhost:1/warbler"
     
 class UserViewTestCase(TestCase):
     """Test views for Users."""
@@ -23,6 +42,9 @@ class UserViewTestCase(TestCase):
 
         self.client = app.test_client()
 
+        login_username_limiter.clear()
+        login_address_limiter.clear()
+
         user0 = User.signup(
                             username='test0', 
                             email='test0@email.com', 
@@ -104,6 +126,23 @@ class UserViewTestCase(TestCase):
             self.assertIn("@test2", str(resp.data))
             self.assertIn("@test3", str(resp.data))
 
+    def test_users_page_follow_buttons(self):
+        """Do user cards show Unfollow only for users being followed"""
+
+        self.user0.following.append(self.user1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            resp = c.get("/users")
+            html = str(resp.data)
+
+            self.assertIn(f'action="/users/stop-following/{self.user1_id}"', html)
+            self.assertIn(f'action="/users/follow/{self.user2_id}"', html)
+            self.assertNotIn(f'action="/users/stop-following/{self.user2_id}"', html)
+
     def test_users_search(self):
         """Does the users page successfully search other users"""
 
@@ -117,6 +156,63 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("@test2", str(resp.data))
             self.assertNotIn("@test3", str(resp.data))
 
+    def test_users_page_paginates(self):
+        """Does /users page through users with a cursor, in HTML and JSON?"""
+
+        for i in range(USERS_PER_PAGE):
+            db.session.add(User(username=f"paged{i}",
+                                email=f"paged{i}@email.com",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users")
+            html = str(resp.data)
+
+            self.assertIn("@test0", html)
+            self.assertNotIn(f"@paged{USERS_PER_PAGE - 1}<", html)
+            self.assertIn("Load more", html)
+
+            resp = c.get("/users?format=json&cursor="
+                         f"{User.query.filter_by(username='paged19').one().id}")
+            data = resp.get_json()
+
+            self.assertIn(f"@paged{USERS_PER_PAGE - 1}<", data["html"])
+            self.assertNotIn("@paged19<", data["html"])
+            self.assertIsNone(data["next"])
+
+    def test_users_page_bad_cursor(self):
+        """Is a malformed cursor rejected?"""
+
+        with self.client as c:
+            resp = c.get("/users?cursor=nonsense")
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_users_search_ranking(self):
+        """Are exact and prefix username matches ranked above bio matches"""
+
+        self.user3.bio = "friend of test1"
+        self.user2.username = "test1abc"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=TEST1")
+            html = str(resp.data)
+
+            self.assertIn("@test3", html)
+            self.assertNotIn("@test0", html)
+            self.assertLess(html.index("@test1<"), html.index("@test1abc"))
+            self.assertLess(html.index("@test1abc"), html.index("@test3"))
+
+    def test_users_search_escapes_wildcards(self):
+        """Is a search for % treated literally"""
+
+        with self.client as c:
+            resp = c.get("/users?q=%25%25%25")
+
+            self.assertIn("Sorry, no users found", str(resp.data))
+
     def test_user_follow(self):
         """Can a user follow another user"""
 
@@ -129,6 +225,91 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@test1", str(resp.data))
 
+    def test_user_follow_backfills_timeline(self):
+        """Do a followed user's messages appear on the follower's homepage?"""
+
+        msg = Message(text="already posted", user_id=self.user1_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+            resp = c.get("/")
+
+            self.assertIn("already posted", str(resp.data))
+
+            c.post(f"/users/stop-following/{self.user1_id}")
+            resp = c.get("/")
+
+            self.assertNotIn("already posted", str(resp.data))
+
+    def test_user_follows_self(self):
+        """Can a user with messages follow themselves, and keep posting?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post("/messages/new", data={"text": "before following myself"})
+
+            resp = c.post(f"/users/follow/{self.user0_id}")
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.post("/messages/new", data={"text": "after following myself"})
+            self.assertEqual(resp.status_code, 302)
+
+            c.post(f"/users/stop-following/{self.user0_id}")
+            resp = c.get("/")
+
+            self.assertIn("before following myself", str(resp.data))
+            self.assertIn("after following myself", str(resp.data))
+
+    def test_follow_counts(self):
+        """Do follow and unfollow keep following/followers counts current?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+
+            self.assertEqual(User.query.get(self.user0_id).following_count, 1)
+            self.assertEqual(User.query.get(self.user1_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.user1_id}")
+
+            self.assertEqual(User.query.get(self.user0_id).following_count, 0)
+            self.assertEqual(User.query.get(self.user1_id).followers_count, 0)
+
+    def test_user_delete_counts(self):
+        """Does deleting a user uncount their follows and likes of their messages?"""
+
+        msg = Message(text="soon gone", user_id=self.user0_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post(f"/users/follow/{self.user0_id}")
+            c.post(f"/messages/{msg_id}/like")
+
+            self.assertEqual(User.query.get(self.user1_id).following_count, 1)
+            self.assertEqual(User.query.get(self.user1_id).likes_count, 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.post("/users/delete")
+
+            self.assertEqual(User.query.get(self.user1_id).following_count, 0)
+            self.assertEqual(User.query.get(self.user1_id).likes_count, 0)
+
     def test_not_logged_in_follow(self):
         """if a not logged in user tries to follow someone, 
            unauthorized redirect should occur"""
@@ -189,6 +370,307 @@ class UserViewTestCase(TestCase):
             self.assertIn("updated bio", str(resp.data))
             self.assertIn("updated location", str(resp.data))
 
+    def test_slow_queries_recorded(self):
+        """Are slow statements recorded, redacted and shown only to admins?"""
+
+        app.config.update(SLOW_QUERY_SECONDS=1e-9, SLOW_QUERY_EXPLAIN=False,
+                          ADMIN_USER_IDS=frozenset([self.user1_id]))
+        slow_queries.configure_slow_queries(app)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user0_id
+
+                with self.assertLogs("slow_queries", "WARNING"):
+                    c.post("/users/profile", data={
+                        "username": "updated",
+                        "email": "hidden@email.com",
+                        "password": "password0"
+                    })
+
+                update = next(query for query in slow_queries.records()
+                              if query.statement.startswith("UPDATE users SET email"))
+                self.assertEqual(update.route, "profile")
+                self.assertIs(update.engine, db.engine)
+                self.assertEqual(update.parameters["email"], "[redacted]")
+
+                self.assertEqual(c.get("/admin/slow-queries").status_code, 404)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+                resp = c.get("/admin/slow-queries")
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("UPDATE users SET", str(resp.data))
+                self.assertNotIn("hidden@email.com", str(resp.data))
+        finally:
+            app.config.update(SLOW_QUERY_SECONDS=slow_queries.DEFAULT_THRESHOLD,
+                              SLOW_QUERY_EXPLAIN=True, ADMIN_USER_IDS=frozenset())
+            slow_queries.configure_slow_queries(app)
+
+    def test_slow_query_failed_statement(self):
+        """Does a statement that raises leave no start time behind?"""
+
+        app.config['SLOW_QUERY_SECONDS'] = 1e-9
+        slow_queries.configure_slow_queries(app)
+        try:
+            with db.engine.connect() as conn:
+                with self.assertRaises(Exception):
+                    conn.exec_driver_sql("SELECT * FROM no_such_table")
+                self.assertEqual(conn.info["slow_query_started"], {})
+        finally:
+            app.config['SLOW_QUERY_SECONDS'] = slow_queries.DEFAULT_THRESHOLD
+            slow_queries.configure_slow_queries(app)
+
+    def test_slow_query_explained(self):
+        """Is a slow SELECT's plan taken in the background?"""
+
+        app.config['SLOW_QUERY_SECONDS'] = 1e-9
+        slow_queries.configure_slow_queries(app)
+        try:
+            self.client.get(f"/users/{self.user0_id}")
+
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                selects = [query for query in slow_queries.records()
+                           if query.statement.startswith("SELECT")
+                           and query.route == "users_show"]
+                if selects and all(query.plan or query.plan_error for query in selects):
+                    break
+                time.sleep(0.05)
+        finally:
+            app.config['SLOW_QUERY_SECONDS'] = slow_queries.DEFAULT_THRESHOLD
+            slow_queries.configure_slow_queries(app)
+
+        self.assertTrue(selects)
+        for query in selects:
+            self.assertIsNone(query.plan_error)
+            self.assertIn("Buffers", query.plan)
+
+    def test_current_user_cached(self):
+        """Is the logged-in user served without a query once cached"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.get("/messages/search")
+
+            with record_queries() as stats:
+                resp = c.get("/messages/search")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('alt="test0"', str(resp.data))
+            self.assertEqual(stats.statements, 0)
+
+    def test_home_counts_cached(self):
+        """Does the home page show the user's counts without loading them, and update them?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.get("/")
+            c.post("/messages/new", data={"text": "counted"})
+            c.get("/")
+
+            with record_queries() as stats:
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse([shape for shape in stats.shapes
+                              if shape.endswith("WHERE users.id = ?")])
+            count = User.query.get(self.user0_id).messages_count
+            html = " ".join(resp.get_data(as_text=True).split())
+            self.assertIn(f'<a href="/users/{self.user0_id}"> {count} </a>', html)
+
+    def test_deleted_current_user_logged_out(self):
+        """Is a user deleted behind their cached record's back logged out?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.get("/messages/search")
+            db.session.delete(User.query.get(self.user0_id))
+            db.session.commit()
+
+            resp = c.get("/users/profile")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "http://localhost/")
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+    def test_edit_user_profile_invalidates_current_user(self):
+        """Does the nav bar show a new username right after a profile edit"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            c.get("/messages/search")
+            c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test0@email.com",
+                "password": "password0",
+            })
+            resp = c.get("/messages/search")
+
+            self.assertIn('alt="renamed"', str(resp.data))
+
+    def test_login_limited_per_username(self):
+        """Once a username's attempts run out, logins are refused unchecked."""
+
+        capacity = login_username_limiter.capacity
+        login_username_limiter.capacity = 2
+        self.addCleanup(setattr, login_username_limiter, 'capacity', capacity)
+
+        for _ in range(2):
+            resp = self.client.post("/login", data={"username": "test0",
+                                                    "password": "wrong-password"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Invalid credentials", str(resp.data))
+
+        checks = hashing_stats()['checks']
+        resp = self.client.post("/login", data={"username": "TEST0",
+                                                "password": "password0"})
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn("Too many login attempts", str(resp.data))
+        self.assertEqual(hashing_stats()['checks'], checks)
+
+        resp = self.client.post("/login", data={"username": "test1",
+                                                "password": "password1"})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_login_limited_per_address(self):
+        """One client can't spread a flood across many usernames."""
+
+        capacity = login_address_limiter.capacity
+        login_address_limiter.capacity = 2
+        self.addCleanup(setattr, login_address_limiter, 'capacity', capacity)
+
+        attacker = {"REMOTE_ADDR": "203.0.113.9"}
+        for username in ("test0", "test1"):
+            resp = self.client.post("/login", environ_base=attacker,
+                                    data={"username": username, "password": "wrong-password"})
+            self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.post("/login", environ_base=attacker,
+                                data={"username": "test2", "password": "password2"})
+        self.assertEqual(resp.status_code, 429)
+
+        resp = self.client.post("/login", environ_base={"REMOTE_ADDR": "198.51.100.7"},
+                                data={"username": "test2", "password": "password2"})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_login_limiter_refills_and_evicts(self):
+        """Buckets refill over time and only the newest keys are kept."""
+
+        limiter = TokenBucketLimiter(rate=1000, capacity=1, max_keys=2)
+        self.assertTrue(limiter.allow("a"))
+        self.assertTrue(limiter.allow("b"))
+        self.assertTrue(limiter.allow("c"))
+        self.assertEqual(len(limiter), 2)
+
+        fast = TokenBucketLimiter(rate=1000, capacity=1)
+        self.assertTrue(fast.allow("a"))
+        time.sleep(0.01)
+        self.assertTrue(fast.allow("a"))
+
+        slow = TokenBucketLimiter(rate=0, capacity=1)
+        self.assertTrue(slow.allow("a"))
+        self.assertFalse(slow.allow("a"))
+
+    def test_users_show_query_budget(self):
+        """Does a profile page stay within its query budget, however many messages?"""
+
+        for i in range(10):
+            db.session.add(Message(text=f"message {i}", user_id=self.user1_id))
+        self.user0.following.append(self.user1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            # the profile's user and the viewer are each loaded by id
+            with query_budget(USERS_SHOW_QUERY_BUDGET, max_repeats=2):
+                resp = c.get(f"/users/{self.user1_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("message 9", str(resp.data))
+
+    def test_profile_pages_conditional(self):
+        """Is a repeat visit to an unchanged profile page one lookup and a 304?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            for page in ("", "/following", "/followers", "/likes"):
+                url = f"/users/{self.user1_id}{page}"
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.cache_control.private)
+
+                with record_queries() as stats:
+                    resp = c.get(url, headers={"If-None-Match": resp.headers["ETag"]})
+                self.assertEqual(resp.status_code, 304)
+                self.assertEqual(stats.statements, 1)
+
+    def test_profile_page_etag_changes(self):
+        """Do the owner's and the viewer's changes invalidate the page?"""
+
+        url = f"/users/{self.user1_id}/followers"
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            etag = c.get(url).headers["ETag"]
+
+            other = app.test_client()
+            with other.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            other.post(f"/users/follow/{self.user1_id}")
+
+            resp = c.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@test2", str(resp.data))
+
+            etag = resp.headers["ETag"]
+            c.post(f"/users/follow/{self.user2_id}")
+
+            resp = c.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", str(resp.data))
+
+    def test_profile_page_etag_follows_csrf_window(self):
+        """Does a logged-in page stop matching before its CSRF token expires?"""
+
+        url = f"/users/{self.user1_id}/followers"
+        app.config.update(WTF_CSRF_ENABLED=True, WTF_CSRF_TIME_LIMIT=2)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user0_id
+
+                # start at the beginning of a one-second window
+                time.sleep(1 - time.time() % 1)
+                etag = c.get(url).headers["ETag"]
+                self.assertEqual(c.get(url, headers={"If-None-Match": etag}).status_code, 304)
+
+                time.sleep(1)
+                self.assertEqual(c.get(url, headers={"If-None-Match": etag}).status_code, 200)
+        finally:
+            app.config.update(WTF_CSRF_ENABLED=False, WTF_CSRF_TIME_LIMIT=3600)
+
+    def test_profile_page_missing_user(self):
+        """Is an unknown user's page still a 404?"""
+
+        resp = self.client.get("/users/999999")
+        self.assertEqual(resp.status_code, 404)
+
     def test_user_delete(self):
         """Can a user delete their profile?"""
 
@@ -232,6 +714,102 @@ class UserViewTestCase(TestCase):
             c.post(f"/messages/{msg_id}/like", follow_redirects=True)
 
             self.assertEqual(len(User.query.get(self.user0_id).liked_messages), 1)
+            self.assertEqual(User.query.get(self.user0_id).likes_count, 1)
+
+    def test_api_toggle_like(self):
+        """Does the JSON endpoint toggle a like in one statement?"""
+
+        msg = Message(text="test message", user_id=self.user1_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            with record_queries() as stats:
+                resp = c.post(f"/api/messages/{msg_id}/like")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"liked": True, "likes": 1})
+            self.assertEqual(sum(count for shape, count in stats.shapes.items()
+                                 if "likes" in shape), 1)
+            self.assertEqual(User.query.get(self.user0_id).likes_count, 1)
+
+            resp = c.post(f"/api/messages/{msg_id}/like")
+            self.assertEqual(resp.json, {"liked": False, "likes": 0})
+            self.assertEqual(User.query.get(self.user0_id).likes_count, 0)
+
+            resp = c.post("/api/messages/999999/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_api_toggle_like_logged_out(self):
+        """Is a logged-out toggle refused with a 401?"""
+
+        resp = self.client.post("/api/messages/1/like")
+        self.assertEqual(resp.status_code, 401)
+
+    def use_like_buffer(self):
+        """Switch on write-behind likes for one test."""
+
+        buffer = likes.LikeBuffer(app, flush_interval=3600)
+        self.addCleanup(setattr, likes, 'buffer', None)
+        self.addCleanup(buffer.close)
+        likes.buffer = buffer
+        return buffer
+
+    def test_buffered_like_collapses(self):
+        """Do a like and an unlike of the same message cancel out?"""
+
+        buffer = self.use_like_buffer()
+        msg = Message(text="test message", user_id=self.user1_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertEqual(buffer.toggle(self.user0_id, msg.id), (True, 1))
+        self.assertEqual(buffer.pending_for(self.user0_id), {msg.id: True})
+        self.assertEqual(buffer.toggle(self.user0_id, msg.id), (False, 0))
+        self.assertEqual(buffer.pending_for(self.user0_id), {})
+        self.assertIsNone(buffer.toggle(self.user0_id, 999999))
+
+    def test_buffered_like_visible_before_flush(self):
+        """Does a buffered like show on the liker's pages before it's written?"""
+
+        self.use_like_buffer()
+        msg = Message(text="test message", user_id=self.user1_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user0_id
+
+            resp = c.post(f"/api/messages/{msg_id}/like")
+            self.assertEqual(resp.json, {"liked": True, "likes": 1})
+            self.assertEqual(Like.query.count(), 0)
+
+            resp = c.get(f"/users/{self.user1_id}")
+            self.assertIn('"fa fa-star"', str(resp.data))
+
+    def test_buffered_likes_flushed(self):
+        """Are buffered toggles written in bulk, with the counts, on close?"""
+
+        buffer = self.use_like_buffer()
+        msgs = [Message(text=f"message {i}", user_id=self.user1_id) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        msg_ids = [msg.id for msg in msgs]
+
+        for msg_id in msg_ids:
+            buffer.toggle(self.user0_id, msg_id)
+        buffer.toggle(self.user2_id, msg_ids[0])
+        buffer.close()
+
+        db.session.expire_all()
+        self.assertEqual(Like.query.count(), 4)
+        self.assertEqual(User.query.get(self.user0_id).likes_count, 3)
+        self.assertEqual(buffer.pending_for(self.user0_id), {})
 
     def test_not_logged_in_user_like(self):
         """Not logged in user should be redirected trying to like a messag
@@ -267,3 +845,90 @@ class UserViewTestCase(TestCase):
 
             self.assertIn("test message", str(resp.data))
             self.assertIn("test0", str(resp.data))
+
+    def use_replicas(self, *urls):
+        """Read from replicas at `urls`; the first has a user the primary hasn't."""
+
+        app.config['SQLALCHEMY_BINDS'] = {
+            f'replica{number}': url for number, url in enumerate(urls)}
+        app.config['REPLICA_BINDS'] = list(app.config['SQLALCHEMY_BINDS'])
+        self.addCleanup(self.stop_replicas)
+
+        engine = db.get_engine(app, bind='replica0')
+        try:
+            db.Model.metadata.create_all(engine)
+        except OperationalError:
+            self.skipTest(f"no replica database at {urls[0]}")
+        with engine.begin() as conn:
+            conn.execute(User.__table__.delete())
+            # an id the primary won't have, so the test's session can't mix them up
+            conn.execute(User.__table__.insert(), {"id": 1_000_000,
+                                                   "username": "replicaonly",
+                                                   "email": "replica@email.com",
+                                                   "password": "password"})
+
+        replicas.configure_replicas(app)
+        replicas.router.check()
+        return engine
+
+    def stop_replicas(self):
+        app.config.update(SQLALCHEMY_BINDS={}, REPLICA_BINDS=[])
+        replicas.configure_replicas(app)
+
+    def test_replica_reads(self):
+        """Do GET requests read from the replica until the client writes?"""
+
+        self.use_replicas(REPLICA_DATABASE_URL)
+
+        with self.client as c:
+            resp = c.get("/users")
+            self.assertIn("replicaonly", str(resp.data))
+            self.assertNotIn("test0", str(resp.data))
+
+            c.post("/login", data={"username": "test0", "password": "wrong"})
+
+            resp = c.get("/users")
+            self.assertIn("test0", str(resp.data))
+            self.assertNotIn("replicaonly", str(resp.data))
+
+            with c.session_transaction() as sess:
+                sess[replicas.PIN_KEY] = 0
+            resp = c.get("/users")
+            self.assertIn("replicaonly", str(resp.data))
+
+    def test_replica_writes_pin_to_primary(self):
+        """Does a write send the rest of a GET request to the primary?"""
+
+        engine = self.use_replicas(REPLICA_DATABASE_URL)
+
+        with app.test_request_context("/users"):
+            self.assertIs(db.session.get_bind(), engine)
+            User.query.filter_by(id=self.user0_id).update({"bio": "updated"})
+            self.assertIs(db.session.get_bind(), db.engine)
+            db.session.rollback()
+
+        with app.test_request_context("/users", method="POST"):
+            self.assertIs(db.session.get_bind(), db.engine)
+
+    def test_replica_rotation(self):
+        """Are healthy replicas used in turn, and lagging or down ones skipped?"""
+
+        engine = self.use_replicas(REPLICA_DATABASE_URL, REPLICA_DATABASE_URL,
+                                   DOWN_DATABASE_URL)
+        router = replicas.router
+
+        self.assertEqual([replica.healthy for replica in router.replicas],
+                         [True, True, False])
+        chosen = [router.choose() for _ in range(4)]
+        self.assertEqual(set(chosen), {engine, db.get_engine(app, bind='replica1')})
+        self.assertIsNot(chosen[0], chosen[1])
+        self.assertIs(chosen[0], chosen[2])
+
+        router.max_lag = -1
+        with self.assertLogs("replicas", "WARNING"):
+            router.check()
+        self.assertIsNone(router.choose())
+
+        resp = self.client.get("/users")
+        self.assertIn("test0", str(resp.data))
+        self.assertNotIn("replicaonly", str(resp.data))
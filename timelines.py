@@ -0,0 +1,377 @@
+"""Materialized home timelines for Warbler.
+
+Every user has a list of (message id, timestamp) rows in `timeline_entries`
+holding the messages their homepage shows. Entries are written when a
+message is posted (fan-out on write) and kept in step with deletes, follows
+and unfollows, so reading a homepage is a single indexed lookup.
+
+Authors who pass `TIMELINE_FANOUT_THRESHOLD` followers are pulled: their
+messages only go to their own timeline, and readers who follow them merge
+their recent messages in at read time (fan-out on read). They stay pulled
+until they drop to the lower `TIMELINE_PUSH_THRESHOLD`, so authors near the
+threshold don't flip back and forth. Switching them back means copying
+their recent messages to every follower, so it isn't done in a request:
+`resume_pushing` (`flask resume-pushing`, run periodically) does it in
+batches. Changing the thresholds needs a `flask rebuild-timelines`.
+
+Pushes and follows trim each timeline they add to back to TIMELINE_LENGTH
+entries as they go, so timelines never grow past it by more than the
+entries of one post or follow.
+"""
+
+import heapq
+from collections import defaultdict
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import func, literal, select, true, tuple_, union_all, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+
+from models import db, Follows, Message, TimelineEntry, User, with_message_authors
+
+TIMELINE_LENGTH = 100
+
+DEFAULT_FANOUT_THRESHOLD = 10000
+
+DEFAULT_PUSH_THRESHOLD = 9000
+
+# Followers backfilled per transaction by `resume_pushing`.
+BACKFILL_BATCH_SIZE = 500
+
+
+def fanout_threshold():
+    """Follower count above which an author's messages are pulled on read."""
+
+    return current_app.config.get('TIMELINE_FANOUT_THRESHOLD',
+                                  DEFAULT_FANOUT_THRESHOLD)
+
+
+def push_threshold():
+    """Follower count at or below which a pulled author is pushed again."""
+
+    return current_app.config.get('TIMELINE_PUSH_THRESHOLD',
+                                  DEFAULT_PUSH_THRESHOLD)
+
+
+def is_pulled_author(user_id):
+    """Are `user_id`'s messages merged in at read time?"""
+
+    return (db.session.query(User.timeline_pulled)
+            .filter(User.id == user_id)
+            .scalar())
+
+
+def start_pulling(author_id):
+    """Pull `author_id`'s messages on read if they've passed the threshold.
+
+    Call this once a follow of `author_id` has been counted.
+    """
+
+    db.session.execute(
+        update(User)
+        .where(User.id == author_id)
+        .where(User.timeline_pulled.is_(False))
+        .where(User.followers_count > fanout_threshold())
+        .values(timeline_pulled=True)
+    )
+
+
+def home_timeline(user_id, limit=TIMELINE_LENGTH):
+    """Return the most recent `limit` messages on `user_id`'s timeline.
+
+    Pushed entries and the recent messages of each pulled author are
+    already sorted newest first, so they are combined with a k-way merge.
+    """
+
+    pushed = db.session.execute(
+        select(TimelineEntry.message_id, TimelineEntry.timestamp)
+        .where(TimelineEntry.user_id == user_id)
+        .order_by(TimelineEntry.timestamp.desc())
+        .limit(limit)
+    ).all()
+
+    streams = [pushed] + _pulled_streams(user_id, limit)
+
+    message_ids = []
+    seen = set()
+    for message_id, _ in heapq.merge(*streams, key=itemgetter(1), reverse=True):
+        if message_id not in seen:
+            seen.add(message_id)
+            message_ids.append(message_id)
+            if len(message_ids) == limit:
+                break
+
+    if not message_ids:
+        return []
+
+    messages = (Message.query
+                .options(with_message_authors)
+                .filter(Message.id.in_(message_ids))
+                .all())
+    position = {message_id: i for i, message_id in enumerate(message_ids)}
+    return sorted(messages, key=lambda message: position[message.id])
+
+
+def _add_entries(rows):
+    """Insert (user_id, message_id, timestamp) `rows`, skipping any already there."""
+
+    db.session.execute(
+        insert(TimelineEntry.__table__)
+        .from_select(['user_id', 'message_id', 'timestamp'], rows)
+        .on_conflict_do_nothing()
+    )
+
+
+def pulled_authors_followed_by(user_id):
+    """Ids of the pulled authors that `user_id` follows."""
+
+    return db.session.execute(
+        select(Follows.user_being_followed_id)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id)
+        .where(User.timeline_pulled)
+    ).scalars().all()
+
+
+def _pulled_streams(user_id, limit):
+    """Recent (id, timestamp) rows of each pulled author `user_id` follows.
+
+    Returns one newest-first list per author. Each author's slice is an
+    index range scan on (user_id, timestamp), fetched in a single query.
+    """
+
+    author_ids = pulled_authors_followed_by(user_id)
+    if not author_ids:
+        return []
+
+    recent = []
+    for author_id in author_ids:
+        author_messages = (select(Message.user_id, Message.id, Message.timestamp)
+                           .where(Message.user_id == author_id)
+                           .order_by(Message.timestamp.desc())
+                           .limit(limit)
+                           .subquery())
+        recent.append(select(author_messages))
+
+    streams = defaultdict(list)
+    for author_id, message_id, timestamp in db.session.execute(union_all(*recent)):
+        streams[author_id].append((message_id, timestamp))
+
+    return [sorted(stream, key=itemgetter(1), reverse=True)
+            for stream in streams.values()]
+
+
+def push_message(message, limit=TIMELINE_LENGTH):
+    """Fan `message` out to its author's and their followers' timelines.
+
+    Messages by pulled authors only go to the author's own timeline.
+    Each timeline written to is trimmed back to `limit` entries.
+    `message` must already be flushed so that it has an id.
+    """
+
+    readers = select(literal(message.user_id).label('user_id'))
+    if not is_pulled_author(message.user_id):
+        # an author who follows themselves is only listed once
+        readers = union_all(
+            readers,
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == message.user_id)
+            .where(Follows.user_following_id != message.user_id),
+        )
+    readers = readers.subquery()
+
+    _add_entries(select(
+        readers.c.user_id,
+        literal(message.id),
+        literal(message.timestamp),
+    ))
+    trim_timelines(limit, user_ids=select(readers.c.user_id))
+
+
+def remove_message(message_id):
+    """Remove a message from every timeline it was pushed to."""
+
+    db.session.execute(
+        TimelineEntry.__table__.delete()
+        .where(TimelineEntry.message_id == message_id)
+    )
+
+
+def backfill_follow(user_id, followed_id, limit=TIMELINE_LENGTH):
+    """Copy `followed_id`'s most recent messages onto `user_id`'s timeline.
+
+    Nothing is copied for pulled authors, whose messages are merged in on
+    read, or for users following themselves, whose messages are already
+    there. Pulled authors waiting on `resume_pushing` are copied anyway,
+    so that nobody who follows them while it runs is missed.
+    """
+
+    if followed_id == user_id:
+        return
+
+    pulled, followers_count = db.session.execute(
+        select(User.timeline_pulled, User.followers_count)
+        .where(User.id == followed_id)
+    ).one()
+    if pulled and followers_count > push_threshold():
+        return
+
+    _add_entries(select(literal(user_id), Message.id, Message.timestamp)
+                 .where(Message.user_id == followed_id)
+                 .order_by(Message.timestamp.desc())
+                 .limit(limit))
+    trim_timelines(limit, user_ids=[user_id])
+
+
+def resume_pushing(limit=TIMELINE_LENGTH, batch_size=BACKFILL_BATCH_SIZE):
+    """Push the messages of pulled authors who've dropped to the push threshold.
+
+    Each author's recent messages are copied to `batch_size` followers
+    at a time, committing and trimming their timelines after each batch,
+    since whoever followed them while they were pulled was never
+    backfilled. Readers keep merging an author's messages in until all
+    of their followers are done.
+    """
+
+    author_ids = db.session.execute(
+        select(User.id)
+        .where(User.timeline_pulled)
+        .where(User.followers_count <= push_threshold())
+    ).scalars().all()
+
+    for author_id in author_ids:
+        recent = (select(Message.id, Message.timestamp)
+                  .where(Message.user_id == author_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(limit)
+                  .subquery())
+
+        last_id = 0
+        while True:
+            follower_ids = db.session.execute(
+                select(Follows.user_following_id)
+                .where(Follows.user_being_followed_id == author_id)
+                .where(Follows.user_following_id != author_id)
+                .where(Follows.user_following_id > last_id)
+                .order_by(Follows.user_following_id)
+                .limit(batch_size)
+            ).scalars().all()
+            if not follower_ids:
+                break
+
+            _add_entries(
+                select(User.id, recent.c.id, recent.c.timestamp)
+                .select_from(User.__table__.join(recent, true()))
+                .where(User.id.in_(follower_ids))
+            )
+            trim_timelines(limit, user_ids=follower_ids)
+            db.session.commit()
+            last_id = follower_ids[-1]
+
+        # followers gained since are backfilled by their follows, unless
+        # the author went back over the push threshold meanwhile
+        db.session.execute(
+            update(User)
+            .where(User.id == author_id)
+            .where(User.followers_count <= push_threshold())
+            .values(timeline_pulled=False)
+        )
+        db.session.commit()
+
+
+def prune_follow(user_id, followed_id):
+    """Drop `followed_id`'s messages from `user_id`'s timeline.
+
+    Users who stop following themselves keep their own messages.
+    """
+
+    if followed_id == user_id:
+        return
+
+    followed_message_ids = select(Message.id).where(Message.user_id == followed_id)
+
+    db.session.execute(
+        TimelineEntry.__table__.delete()
+        .where(TimelineEntry.user_id == user_id)
+        .where(TimelineEntry.message_id.in_(followed_message_ids))
+    )
+
+
+def trim_timelines(limit=TIMELINE_LENGTH, user_ids=None):
+    """Drop all but the newest `limit` entries of each timeline.
+
+    Trims the timelines of `user_ids` (a list or a select of ids), or of
+    every user. Each timeline's cutoff is the timestamp of its `limit`th
+    entry, found with one index range scan on (user_id, timestamp).
+    """
+
+    owners = select(User.id)
+    if user_ids is not None:
+        owners = owners.where(User.id.in_(user_ids))
+
+    kept = aliased(TimelineEntry)
+    cutoffs = owners.add_columns(
+        select(kept.timestamp)
+        .where(kept.user_id == User.id)
+        .order_by(kept.timestamp.desc())
+        .offset(limit - 1)
+        .limit(1)
+        .scalar_subquery()
+        .label('cutoff')
+    ).subquery()
+
+    surplus = (select(TimelineEntry.user_id, TimelineEntry.message_id)
+               .join(cutoffs, TimelineEntry.user_id == cutoffs.c.id)
+               .where(TimelineEntry.timestamp < cutoffs.c.cutoff))
+
+    db.session.execute(
+        TimelineEntry.__table__.delete()
+        .where(tuple_(TimelineEntry.user_id, TimelineEntry.message_id).in_(surplus))
+    )
+
+
+def rebuild_timelines(limit=TIMELINE_LENGTH):
+    """Recompute every timeline from the messages and follows tables.
+
+    Used on a cold start (or after a bulk load) to populate
+    `timeline_entries` with the `limit` most recent messages per user.
+    Authors over the fan-out threshold are pulled, and their messages
+    only added to their own timelines, so follower counts must be
+    current (see `user_stats.repair_user_stats`).
+    """
+
+    db.session.execute(
+        update(User).values(timeline_pulled=User.followers_count > fanout_threshold()))
+    pulled_authors = select(User.id).where(User.timeline_pulled)
+
+    readers = union_all(
+        select(Message.user_id.label('reader_id'),
+               Message.id.label('message_id'),
+               Message.timestamp.label('timestamp')),
+        select(Follows.user_following_id,
+               Message.id,
+               Message.timestamp)
+        .join(Message, Message.user_id == Follows.user_being_followed_id)
+        .where(Follows.user_being_followed_id.not_in(pulled_authors))
+        .where(Follows.user_following_id != Follows.user_being_followed_id),
+    ).subquery()
+
+    ranked = select(
+        readers.c.reader_id,
+        readers.c.message_id,
+        readers.c.timestamp,
+        func.row_number().over(
+            partition_by=readers.c.reader_id,
+            order_by=readers.c.timestamp.desc(),
+        ).label('position'),
+    ).subquery()
+
+    rows = (select(ranked.c.reader_id, ranked.c.message_id, ranked.c.timestamp)
+            .where(ranked.c.position <= limit))
+
+    db.session.execute(TimelineEntry.__table__.delete())
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], rows)
+    )
@@ -0,0 +1,150 @@
+"""Denormalized per-user counts and version stamps.
+
+`User.messages_count`, `following_count`, `followers_count` and
+`likes_count` let pages show a user's stats without loading their
+relationships. Each write path calls the matching function here before
+committing, so the counts change in the same transaction as the rows
+they count. (Likes are the exception: likes.toggle_like adjusts the
+liker's count inside its own statement.) `repair_user_stats`
+recomputes them from the base tables.
+
+Every adjustment also bumps `User.version` for each user whose pages it
+changes, so a page's ETag can be built from its owner's and viewer's
+versions without querying what the page lists.
+"""
+
+from sqlalchemy import func, or_, select, update
+
+from current_user import invalidate_after_commit
+from models import db, Follows, Like, Message, User
+
+
+def _adjust(user_ids, **deltas):
+    """Add `deltas` (column name -> amount) to the counts of `user_ids`.
+
+    `user_ids` is a single id or a select of ids. Their versions are
+    bumped too, and a single user's cached current-user record is
+    forgotten on commit.
+    """
+
+    deltas = {**deltas, 'version': 1}
+
+    if isinstance(user_ids, int):
+        condition = User.id == user_ids
+        invalidate_after_commit(user_ids)
+    else:
+        condition = User.id.in_(user_ids)
+
+    db.session.execute(
+        update(User)
+        .where(condition)
+        .values({getattr(User, name): getattr(User, name) + delta
+                 for name, delta in deltas.items()})
+        .execution_options(synchronize_session=False)
+    )
+
+
+def message_added(user_id):
+    """Count a new message by `user_id`."""
+
+    _adjust(user_id, messages_count=1)
+
+
+def message_deleted(message):
+    """Uncount `message` and the likes that will be deleted with it."""
+
+    _adjust(message.user_id, messages_count=-1)
+    _adjust(select(Like.user_id).where(Like.message_id == message.id),
+            likes_count=-1)
+
+
+def follow_added(user_id, followed_id):
+    """Count `user_id` following `followed_id`."""
+
+    _adjust(user_id, following_count=1)
+    _adjust(followed_id, followers_count=1)
+
+
+def follow_removed(user_id, followed_id):
+    """Uncount `user_id` following `followed_id`."""
+
+    _adjust(user_id, following_count=-1)
+    _adjust(followed_id, followers_count=-1)
+
+
+def user_deleted(user_id):
+    """Uncount everything that will cascade away with `user_id`.
+
+    Their follows leave other users' follower/following counts, and
+    other users' likes of their messages leave those users' like counts.
+    """
+
+    _adjust(select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id),
+            followers_count=-1)
+    _adjust(select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id),
+            following_count=-1)
+
+    likes_of_their_messages = (select(Like.user_id)
+                               .join(Message, Message.id == Like.message_id)
+                               .where(Message.user_id == user_id))
+    likes_by_liker = (select(func.count())
+                      .select_from(Like)
+                      .join(Message, Message.id == Like.message_id)
+                      .where(Message.user_id == user_id)
+                      .where(Like.user_id == User.id)
+                      .scalar_subquery())
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(likes_of_their_messages))
+        .values(likes_count=User.likes_count - likes_by_liker,
+                version=User.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def profile_changed(user_id):
+    """Bump the versions of every user whose pages show `user_id`'s profile.
+
+    That's the user, the users on either end of their follows (whose
+    following and followers pages list them) and the users who liked
+    their messages.
+    """
+
+    _adjust(user_id)
+    _adjust(select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id))
+    _adjust(select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id))
+    _adjust(select(Like.user_id)
+            .join(Message, Message.id == Like.message_id)
+            .where(Message.user_id == user_id))
+
+
+def repair_user_stats():
+    """Recompute every user's counts from messages, follows and likes.
+
+    Users whose counts were wrong get their versions bumped too.
+    """
+
+    def count(table, column):
+        return (select(func.count())
+                .select_from(table)
+                .where(column == User.id)
+                .scalar_subquery())
+
+    counts = {
+        'messages_count': count(Message.__table__, Message.user_id),
+        'following_count': count(Follows.__table__, Follows.user_following_id),
+        'followers_count': count(Follows.__table__, Follows.user_being_followed_id),
+        'likes_count': count(Like.__table__, Like.user_id),
+    }
+
+    db.session.execute(
+        update(User)
+        .where(or_(*(getattr(User, name) != value for name, value in counts.items())))
+        .values(**counts, version=User.version + 1)
+        .execution_options(synchronize_session=False)
+    )